@@ -3,9 +3,10 @@
 #
 # posix_ipcûṩźͨcffiʵ֡
 # 
-import sys, os, errno, struct
+import sys, os, errno, struct, time
 import contextlib
 import mmap
+import zlib
 import cffi
 from structview import *
 
@@ -94,7 +95,7 @@ class Sem(object):
         self.init()
     def init(self):
         if self.init_value != None:
-            init(self.mm, self.idx, value)
+            init(self.mm, self.idx, self.init_value)
     def destroy(self):
         if self.init_value != None:
             destroy(self.mm, self.idx)
@@ -374,20 +375,220 @@ class WorkerChannel(object):
 #             <total item count> : ϣitem
 #             <bucket header list> : ̶СBucketHeaderб
 #             <data block list> : DataBlockб
-# DataBlockĴСItemHeaderСıʼʱȴӿͷnDataBlockʼItemHeaderб
-# ûпItemHeaderˣٴӿDataBlockһûпDataBlockôʾϣ
-# ItemHeaderСΪ16ֽڣ: 
+# ָ붼mm_startƫƣ0ʾָ롣key/valuebyteskeyĹϣֵcrc32̼ͬĹϣֵһġ
+# DataBlockĴСItemHeaderСıûпItemHeaderʱӿDataBlockһ飬ֳɶItemHeader
+# ûпDataBlockôʾϣDataBlockĿͷ4ָֽһDataBlock
+# ItemHeaderСΪ20ֽڣ: 
 #     <next item header pointer> : 4ֽ
-#     <key size> : 2ֽ
-#     <value size> : 2ֽ
+#     <key size> : 4ֽ
+#     <value size> : 4ֽ
 #     <key hash value> : 4ֽڣkeyĹϣֵ
 #     <data block pointer> : ָ򱣴key/valueĵһDataBlockݿ4ָֽһݿ飬һݿ4ֽڲָ롣
 # BucketHeaderĴСΪ8ֽڣ: 
 #     <item header pointer> : 4ֽڣָһItemHeader
 #     <item count> : 4ֽڣͰеitem
 # 
-class HashTable(object):
-    pass
+# (semvalue=1)ʼдbucket count(semvalue=None)ȵbucket countΪ0֮ſʹá
+# 
+class HashTable(ShmObjectBase):
+    ITEM_HEADER = struct.Struct('=IIIII')
+    BUCKET_HEADER = struct.Struct('=II')
+    POINTER = struct.Struct('=I')
+    @classmethod
+    def create(cls, bucketnum, blocknum, blocksz):
+        sz = cls.mmsize(bucketnum, blocknum, blocksz)
+        mm = mmap.mmap(-1, sz)
+        return cls(mm, bucketnum=bucketnum, blocksz=blocksz)
+    @classmethod
+    def mmsize(cls, bucketnum, blocknum, blocksz):
+        return Sem.SIZE + struct.calcsize('=IIIII') + bucketnum * cls.BUCKET_HEADER.size + blocknum * blocksz
+    # semvalue=None ʾʼbucketnum/blockszӹڴжȡtimeoutָȴ롣
+    def __init__(self, mm, start=0, end=-1, bucketnum=0, blocksz=0, semvalue=1, timeout=10):
+        super().__init__(blocksz, mm, start, end, semvalue)
+        self.header = structview('=', 'IIIII', self.mm, self.mm_start + Sem.SIZE, fields='bucketnum blocksz idle_item idle_block count')
+        if semvalue == None:
+            t = time.time() + timeout
+            while self.header.bucketnum == 0:
+                if time.time() > t:
+                    raise RuntimeError('HashTable is not initialized after %s seconds' % timeout)
+                time.sleep(0.01)
+            bucketnum = self.header.bucketnum
+            blocksz = self.itemsz = self.header.blocksz
+        elif bucketnum <= 0 or blocksz <= 0 or blocksz % self.ITEM_HEADER.size:
+            raise RuntimeError('bucketnum(%s) should > 0 and blocksz(%s) should be multiple of %d' % (bucketnum, blocksz, self.ITEM_HEADER.size))
+        self.bucketnum = bucketnum
+        self.bucket_idx = self.header.nextpos()
+        self.data_idx = self.bucket_idx + bucketnum * self.BUCKET_HEADER.size
+        self._misc_init()
+        if self.itemnum <= 0:
+            raise RuntimeError('mm has not enough space for data block')
+        if semvalue != None:
+            self._init_data()
+    def _init_data(self):
+        self.mm[self.bucket_idx:self.data_idx] = bytes(self.data_idx - self.bucket_idx)
+        for i in range(self.itemnum):
+            blk = self.data_idx + i * self.itemsz
+            nxt = blk + self.itemsz - self.mm_start if i < self.itemnum - 1 else 0
+            self.POINTER.pack_into(self.mm, blk, nxt)
+        self.header.idle_item = 0
+        self.header.idle_block = self.data_idx - self.mm_start
+        self.header.count = 0
+        self.header.blocksz = self.itemsz
+        self.header.bucketnum = self.bucketnum
+    def __len__(self):
+        return self.count()
+    def count(self, timeout=-1):
+        with self.sem.wait(timeout):
+            return self.header.count
+    # szָ෵valueǰٸֽڣsz<0ʾvalueûkeyʱ򷵻None
+    def get(self, key, sz=-1, timeout=-1):
+        h = zlib.crc32(key)
+        with self.sem.wait(timeout):
+            _, _, item = self._find(key, h)
+            if not item:
+                return None
+            _, ksz, vsz, _, blk = self.ITEM_HEADER.unpack_from(self.mm, self.mm_start + item)
+            if sz < 0 or sz > vsz:
+                sz = vsz
+            return self._read_data(blk, ksz + vsz, ksz + sz)[ksz:]
+    # ѾkeyôɾɵitemFalseʾϣʱɵitemҲѾɾˡ
+    def put(self, key, value, timeout=-1):
+        h = zlib.crc32(key)
+        with self.sem.wait(timeout):
+            self._remove(key, h)
+            sz = len(key) + len(value)
+            item = self._alloc_item()
+            if not item:
+                return False
+            blk_list = self._alloc_blocks(self._block_count(sz))
+            if not blk_list:
+                self._free_item(item)
+                return False
+            self._write_data(blk_list, key, value)
+            bucket = self.bucket_idx + (h % self.bucketnum) * self.BUCKET_HEADER.size
+            first, cnt = self.BUCKET_HEADER.unpack_from(self.mm, bucket)
+            self.ITEM_HEADER.pack_into(self.mm, self.mm_start + item, first, len(key), len(value), h, blk_list[0])
+            self.BUCKET_HEADER.pack_into(self.mm, bucket, item, cnt + 1)
+            self.header.count = self.header.count + 1
+            return True
+    # Trueʾkeyڲɾ
+    def remove(self, key, timeout=-1):
+        h = zlib.crc32(key)
+        with self.sem.wait(timeout):
+            return self._remove(key, h)
+    # keyб
+    def keys(self, timeout=-1):
+        res = []
+        with self.sem.wait(timeout):
+            for i in range(self.bucketnum):
+                item = self.BUCKET_HEADER.unpack_from(self.mm, self.bucket_idx + i * self.BUCKET_HEADER.size)[0]
+                while item:
+                    nxt, ksz, vsz, _, blk = self.ITEM_HEADER.unpack_from(self.mm, self.mm_start + item)
+                    res.append(self._read_data(blk, ksz + vsz, ksz))
+                    item = nxt
+        return res
+    # ؿDataBlock
+    def idle_blocks(self, timeout=-1):
+        with self.sem.wait(timeout):
+            cnt = 0
+            blk = self.header.idle_block
+            while blk:
+                cnt += 1
+                blk = self.POINTER.unpack_from(self.mm, self.mm_start + blk)[0]
+            return cnt
+    # (bucket, prev_item, item)item=0ʾûҵ
+    def _find(self, key, h):
+        bucket = self.bucket_idx + (h % self.bucketnum) * self.BUCKET_HEADER.size
+        prev, item = 0, self.BUCKET_HEADER.unpack_from(self.mm, bucket)[0]
+        while item:
+            nxt, ksz, vsz, hv, blk = self.ITEM_HEADER.unpack_from(self.mm, self.mm_start + item)
+            if hv == h and ksz == len(key) and self._read_data(blk, ksz + vsz, ksz) == key:
+                return (bucket, prev, item)
+            prev, item = item, nxt
+        return (bucket, prev, 0)
+    def _remove(self, key, h):
+        bucket, prev, item = self._find(key, h)
+        if not item:
+            return False
+        nxt, ksz, vsz, _, blk = self.ITEM_HEADER.unpack_from(self.mm, self.mm_start + item)
+        first, cnt = self.BUCKET_HEADER.unpack_from(self.mm, bucket)
+        if prev:
+            self.POINTER.pack_into(self.mm, self.mm_start + prev, nxt)
+        else:
+            first = nxt
+        self.BUCKET_HEADER.pack_into(self.mm, bucket, first, cnt - 1)
+        self._free_blocks(blk, self._block_count(ksz + vsz))
+        self._free_item(item)
+        self.header.count = self.header.count - 1
+        return True
+    # szֽҪDataBlockһ飬ÿ4ָֽ롣
+    def _block_count(self, sz):
+        n = (sz - self.POINTER.size + self.itemsz - self.POINTER.size - 1) // (self.itemsz - self.POINTER.size)
+        return max(n, 1)
+    def _alloc_item(self):
+        item = self.header.idle_item
+        if not item:
+            blk_list = self._alloc_blocks(1)
+            if not blk_list:
+                return 0
+            # DataBlockֳɶItemHeader
+            item = blk_list[0]
+            n = self.itemsz // self.ITEM_HEADER.size
+            for i in range(n):
+                nxt = item + (i + 1) * self.ITEM_HEADER.size if i < n - 1 else 0
+                self.ITEM_HEADER.pack_into(self.mm, self.mm_start + item + i * self.ITEM_HEADER.size, nxt, 0, 0, 0, 0)
+        self.header.idle_item = self.POINTER.unpack_from(self.mm, self.mm_start + item)[0]
+        return item
+    def _free_item(self, item):
+        self.ITEM_HEADER.pack_into(self.mm, self.mm_start + item, self.header.idle_item, 0, 0, 0, 0)
+        self.header.idle_item = item
+    # nDataBlockDataBlockбDataBlockʱ򷵻None
+    def _alloc_blocks(self, n):
+        blk_list = []
+        blk = self.header.idle_block
+        while blk and len(blk_list) < n:
+            blk_list.append(blk)
+            blk = self.POINTER.unpack_from(self.mm, self.mm_start + blk)[0]
+        if len(blk_list) < n:
+            return None
+        self.header.idle_block = blk
+        return blk_list
+    def _free_blocks(self, blk, n):
+        idle = self.header.idle_block
+        for i in range(n):
+            nxt = self.POINTER.unpack_from(self.mm, self.mm_start + blk + self.itemsz - self.POINTER.size)[0] if i < n - 1 else 0
+            self.POINTER.pack_into(self.mm, self.mm_start + blk, idle)
+            idle, blk = blk, nxt
+        self.header.idle_block = idle
+    def _write_data(self, blk_list, key, value):
+        data = memoryview(b''.join((key, value)))
+        sidx = 0
+        payload = self.itemsz - self.POINTER.size
+        for i, blk in enumerate(blk_list):
+            idx = self.mm_start + blk
+            if i < len(blk_list) - 1:
+                self.mm[idx:idx+payload] = data[sidx:sidx+payload]
+                self.POINTER.pack_into(self.mm, idx + payload, blk_list[i+1])
+                sidx += payload
+            else:
+                self.mm[idx:idx+len(data)-sidx] = data[sidx:]
+    # ȡܹtotalֽڵDataBlockеǰszֽ
+    def _read_data(self, blk, total, sz):
+        if total <= self.itemsz:
+            idx = self.mm_start + blk
+            return self.mm[idx:idx+sz]
+        parts = []
+        payload = self.itemsz - self.POINTER.size
+        while sz > 0:
+            idx = self.mm_start + blk
+            n = payload if total > self.itemsz else total
+            n = min(n, sz)
+            parts.append(self.mm[idx:idx+n])
+            sz -= n
+            total -= payload
+            if sz > 0:
+                blk = self.POINTER.unpack_from(self.mm, idx + payload)[0]
+        return b''.join(parts)
 # main
 if __name__ == '__main__':
     pass
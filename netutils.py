@@ -17,6 +17,12 @@ elif os.name == 'posix':
 else:
     NONBLOCK_SEND_RECV_OK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.WSAEWOULDBLOCK)
     NONBLOCK_CONNECT_EX_OK = (errno.WSAEINPROGRESS, 0)
+# sendmsgһ෢Ͷٸbufferwindowssocketûsendmsg
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
 
 # 1/2fobj
 POLLIN = 0x01
@@ -26,15 +32,42 @@ POLLINOUT = POLLIN|POLLOUT
 POLLINERR = POLLIN|POLLERR
 POLLOUTERR = POLLOUT|POLLERR
 POLLINOUTERR = POLLIN|POLLOUT|POLLERR
+# (fd, event)б(r_list, w_list, e_list)
+# posixselect.pollfdֵFD_SETSIZE(1024)ơ
+if hasattr(select, 'poll'):
+    def _select(fd_events, timeout):
+        p = select.poll()
+        for fd, event in fd_events:
+            mask = 0
+            mask |= select.POLLIN if event & POLLIN else 0
+            mask |= select.POLLOUT if event & POLLOUT else 0
+            mask |= select.POLLPRI if event & POLLERR else 0
+            p.register(fd, mask)
+        res = p.poll(None if timeout is None else timeout * 1000)
+        r_list, w_list, e_list = [], [], []
+        events = dict(fd_events)
+        for fd, revent in res:
+            # ߶Զ˹رյʱ򣬺selectһɶ/дɺĶд
+            if events[fd] & POLLIN and revent & (select.POLLIN|select.POLLERR|select.POLLHUP):
+                r_list.append(fd)
+            if events[fd] & POLLOUT and revent & (select.POLLOUT|select.POLLERR|select.POLLHUP):
+                w_list.append(fd)
+            if events[fd] & POLLERR and revent & (select.POLLPRI|select.POLLERR):
+                e_list.append(fd)
+        return r_list, w_list, e_list
+else:
+    def _select(fd_events, timeout):
+        r_list, w_list, e_list = [], [], []
+        for fd, event in fd_events:
+            r_list.append(fd) if event & POLLIN else None
+            w_list.append(fd) if event & POLLOUT else None
+            e_list.append(fd) if event & POLLERR else None
+        return select.select(r_list, w_list, e_list, timeout)
 def poll(fobj, event, timeout=None):
     if timeout != None and timeout < 0: # ֵʾblockpoll/epollͬ
         timeout = None
     fd = fobj.fileno() if type(fobj) is not int else fobj
-    r_list, w_list, e_list = [], [], []
-    r_list.append(fd) if event & POLLIN else None
-    w_list.append(fd) if event & POLLOUT else None
-    e_list.append(fd) if event & POLLERR else None
-    r_list, w_list, e_list = select.select(r_list, w_list, e_list, timeout)
+    r_list, w_list, e_list = _select(((fd, event),), timeout)
     return bool(r_list), bool(w_list), bool(e_list)
 def pollin(fobj, timeout=None):
     return poll(fobj, POLLIN, timeout)[0]
@@ -54,12 +87,7 @@ def poll2(fobj1, event1, fobj2, event2, timeout=None):
         timeout = None
     fd1 = fobj1.fileno() if type(fobj1) is not int else fobj1
     fd2 = fobj2.fileno() if type(fobj2) is not int else fobj2
-    r_list, w_list, e_list = [], [], []
-    for fd, event in ((fd1, event1), (fd2, event2)):
-        r_list.append(fd) if event & POLLIN else None
-        w_list.append(fd) if event & POLLOUT else None
-        e_list.append(fd) if event & POLLERR else None
-    r_list, w_list, e_list = select.select(r_list, w_list, e_list, timeout)
+    r_list, w_list, e_list = _select(((fd1, event1), (fd2, event2)), timeout)
     return tuple((fd in r_list, fd in w_list, fd in e_list) for fd in (fd1, fd2))
 def poll2in(fobj1, fobj2, timeout=None):
     x = poll2(fobj1, POLLIN, fobj2, POLLIN, timeout)
@@ -214,7 +242,12 @@ if os.name == 'posix':
         def register(self, fobj, eventmask):
             ret = super().register(fobj, eventmask)
             if ret[1]:
-                self.p.unregister(ret[0])
+                # Ѿעfdֱmodifyfdע״̬±closeˣôںѾepollɾˡ
+                try:
+                    self.p.modify(ret[0], eventmask)
+                    return
+                except FileNotFoundError:
+                    pass
             self.p.register(ret[0], eventmask)
         def modify(self, fobj, eventmask):
             ret = super().modify(fobj, eventmask)
@@ -237,6 +270,52 @@ else:
     poller = spoller
     epoller = spoller
 # 
+# ڻpollе̣߳wakerעᵽpoller(POLLIN)̵߳wakeup
+# pollwakerɶ֮clearlinuxeventfdϵͳsocketpair
+# ֮ǰwakeupûбclearôظд
+# 
+class waker():
+    def __init__(self):
+        self.pending = False
+        if hasattr(os, 'eventfd'):
+            self.rs = self.ws = None
+            self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK|os.EFD_CLOEXEC)
+        else:
+            self.rs, self.ws = socket.socketpair()
+            self.rs.settimeout(0)
+            self.ws.settimeout(0)
+            self.rfd, self.wfd = self.rs.fileno(), self.ws.fileno()
+    def fileno(self):
+        return self.rfd
+    def wakeup(self):
+        if self.pending:
+            return
+        self.pending = True
+        try:
+            if self.ws is None:
+                os.eventfd_write(self.wfd, 1)
+            else:
+                self.ws.send(b'w')
+        except BlockingIOError:
+            pass # ûȡݣpollȻ᷵ؿɶ
+    # ȶȡpending֮õwakeupдݻᱻ֮wakeupдݡ
+    def clear(self):
+        try:
+            if self.ws is None:
+                os.eventfd_read(self.rfd)
+            else:
+                while self.rs.recv(4096):
+                    pass
+        except BlockingIOError:
+            pass
+        self.pending = False
+    def close(self):
+        if self.ws is None:
+            os.close(self.rfd)
+        else:
+            self.rs.close()
+            self.ws.close()
+# 
 # sǷģʹͨpoll⵽ɶҲܷNone
 # ΪpollܷؼٵĿɶźŻ߿ɶchecksumʧܣҪԷش
 # Ҫ鷵ֵǷΪNone
@@ -256,6 +335,15 @@ def myrecv(s, bufsize=4096):
             return None
         raise
     return data
+# myrecvһֱֻӽյbuf(bytearray/memoryview)Уؽյֽ
+def myrecv_into(s, buf):
+    try:
+        sz = s.recv_into(buf)
+    except OSError as ex:
+        if ex.errno in NONBLOCK_SEND_RECV_OK:
+            return None
+        raise
+    return sz
 # 
 # szֽڡ֮ǰӦðsΪҲs.settimeout(None)
 # ԶѾclose׳쳣
@@ -269,10 +357,13 @@ def recv_size(s, sz):
         ret += tmp
         sz -= len(tmp)
     return ret
+# reuseport=Trueʱ̿Լͬһ˿ڣں˰ӷַЩ̡
 class listener():
-    def __init__(self, addr, *, async=False, family=socket.AF_INET):
+    def __init__(self, addr, *, async=False, family=socket.AF_INET, reuseport=False):
         self.s = socket.socket(family, socket.SOCK_STREAM)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.s.bind(addr)
         self.s.listen()
         if async:
@@ -342,7 +433,13 @@ class uds_ep(object):
                 return (len(data), None)
         
         if msg_type == b'f':
-            data, ancdata, flags, addr = self.s.recvmsg(1, socket.CMSG_LEN(self.MAXFD*self.FDSIZE))
+            # Ϣ֮󵥶͵ģʱܻûе
+            try:
+                data, ancdata, flags, addr = self.s.recvmsg(1, socket.CMSG_LEN(self.MAXFD*self.FDSIZE))
+            except BlockingIOError:
+                return (0, None)
+            if not data:
+                raise RuntimeError('the peer(%s) closed the connection' % (self.s.getpeername(), ))
             for cmsg in ancdata:
                 fddata = cmsg[2]
                 tail_len = len(fddata) % self.FDSIZE
@@ -403,6 +500,34 @@ class uds_ep(object):
                 return False
         return True
     # 
+    # пɶϢ(msg_type, msg_data, fdlist)б
+    # ԷϢ̹֮رӣôȷѽյϢ´εõʱ׳쳣
+    # 
+    def recv_msgs(self):
+        msg_list = []
+        while True:
+            try:
+                n, msg = self.recv()
+            except (RuntimeError, OSError):
+                if msg_list:
+                    return msg_list
+                raise
+            if n == 0:
+                return msg_list
+            if n < 0:
+                msg_list.append(msg)
+    # 
+    # дϢֱΪֹ
+    # 
+    def send_all(self):
+        while True:
+            try:
+                if not self.send():
+                    return
+            except BlockingIOError:
+                pass
+            pollout(self)
+    # 
     # һϢ
     # 
     @staticmethod
@@ -5,7 +5,7 @@
 # 
 import sys, os, socket, time
 import traceback
-import functools, collections
+import functools, collections, itertools, tempfile
 import getpass
 import netutils
 import miscutils
@@ -40,13 +40,25 @@ def quote_ident(v):
 @netutils.pollize
 class connbase():
     log_msg = False
+    # Ͷеݳspool_thresholdֽڵʱ򣬺дʱļ(spool_dir)͵ʱٶ0ʾдʱļ
+    spool_threshold = 0
+    spool_dir = None
     def __init__(self, s):
         self.s = s
         self.s.settimeout(0)
-        self.recv_buf = b''
-        self.send_buf = b''
+        # recv_buf[recv_sidx:recv_eidx]ǻûзݡϢֱrecv_buf(memoryview)
+        # Ѿյݲᱻǣռ䲻ʱµrecv_bufֻûзݡ
+        self.recv_buf = bytearray()
+        self.recv_sidx = self.recv_eidx = 0
+        # ͶУbytes/memoryviewͨsendmsgһηͶַ͵ʱֻҪѵһmemoryviewƬ
+        self.send_bufs = collections.deque()
+        self.send_sz = 0 # Ͷлûз͵ֽʱļеݡ
+        self.spool_file = None
+        self.spool_sz = 0 # ʱļлûз͵ֽ
+        self.spool_roff = self.spool_woff = 0
         self.readsz = -1 # _readÿȡֽڣ<=0ʾޡ
         self.readunit = 32*1024
+        self.recvbufsz = 4*self.readunit # ·recv_bufСС
     def is_fe(self):
         raise RuntimeError('should not call connbase.is_fe()')
     def fileno(self):
@@ -54,44 +66,104 @@ class connbase():
     def close(self):
         self.s.close()
         self.status = 'disconnected'
+        if self.spool_file:
+            self.spool_file.close()
+            self.spool_file = None
     def __repr__(self):
-        return '<%s peer=%s>' % (type(self).__name__, self.s.getpeername())
+        return '<%s peer=%s>' % (type(self).__name__, self.peername())
+    # ԶѾϿѾcloseʱgetpeername׳쳣ʱNone
+    def peername(self):
+        try:
+            return self.s.getpeername()
+        except OSError:
+            return None
     def __getattr__(self, name):
         return getattr(self.s, name)
+    # ֤recv_bufĩβszֽڵĿпռ
+    def _reserve_recv_buf(self, sz):
+        if len(self.recv_buf) - self.recv_eidx >= sz:
+            return
+        n = self.recv_eidx - self.recv_sidx
+        buf = bytearray(max(self.recvbufsz, 2*(n + sz)))
+        buf[:n] = memoryview(self.recv_buf)[self.recv_sidx:self.recv_eidx]
+        self.recv_buf = buf
+        self.recv_sidx, self.recv_eidx = 0, n
     # ȡֱûݿɶ
     def _read(self):
         while True:
+            self._reserve_recv_buf(self.readunit)
+            buf = memoryview(self.recv_buf)[self.recv_eidx:]
             try:
-                data = netutils.myrecv(self.s, self.readunit)
+                sz = netutils.myrecv_into(self.s, buf)
             except ConnectionError as ex:
                 raise pgfatal(None, '%s' % ex, self)
-            if data is None:
+            if sz is None:
                 break
-            elif not data:
-                raise pgfatal(None, 'the peer(%s) closed connection' % (self.s.getpeername(),), self)
-            self.recv_buf += data
-            if len(data) < self.readunit:
+            elif not sz:
+                raise pgfatal(None, 'the peer(%s) closed connection' % (self.peername(),), self)
+            self.recv_eidx += sz
+            if sz < len(buf):
                 break
-            if self.readsz > 0 and len(self.recv_buf) >= self.readsz:
+            if self.readsz > 0 and self.recv_eidx - self.recv_sidx >= self.readsz:
                 break
+    def _queue_send_data(self, data):
+        if not data:
+            return
+        if self.spool_sz or (self.spool_threshold > 0 and self.send_sz + len(data) > self.spool_threshold):
+            self._spool_data(data)
+        else:
+            self.send_bufs.append(data)
+        self.send_sz += len(data)
+    # ׷ӵʱļ
+    def _spool_data(self, data):
+        if self.spool_file is None:
+            self.spool_file = tempfile.TemporaryFile(dir=self.spool_dir)
+        self.spool_file.seek(self.spool_woff)
+        self.spool_file.write(data)
+        self.spool_woff += len(data)
+        self.spool_sz += len(data)
+    # ʱļȡspool_thresholdֽڷŵͶУʱļеݶ֮ļ
+    def _unspool_data(self):
+        self.spool_file.seek(self.spool_roff)
+        data = self.spool_file.read(min(self.spool_sz, self.spool_threshold))
+        self.spool_roff += len(data)
+        self.spool_sz -= len(data)
+        self.send_bufs.append(data)
+        if not self.spool_sz:
+            self.spool_file.truncate(0)
+            self.spool_roff = self.spool_woff = 0
+    # ֱͶΪջsocketķͻ
     def _write(self):
-        if self.send_buf:
+        while self.send_bufs or self.spool_sz:
+            if not self.send_bufs:
+                self._unspool_data()
             try:
-                sz = self.s.send(self.send_buf)
+                if netutils.HAS_SENDMSG:
+                    sz = self.s.sendmsg(itertools.islice(self.send_bufs, netutils.IOV_MAX))
+                else:
+                    sz = self.s.send(self.send_bufs[0])
             except ConnectionError as ex:
                 raise pgfatal(None, '%s' % ex, self)
             except BlockingIOError:
                 return
-            self.send_buf = self.send_buf[sz:]
+            self.send_sz -= sz
+            while sz > 0:
+                buf = self.send_bufs[0]
+                if sz < len(buf):
+                    self.send_bufs[0] = memoryview(buf)[sz:]
+                    return
+                self.send_bufs.popleft()
+                sz -= len(buf)
     # ͨöдϢ
     # Ϣбmax_msgָ෵ضٸϢ
     def _read_x_msgs(self, parsefunc, max_msg=0, stop=None):
         self._read()
-        if not self.recv_buf:
+        if self.recv_sidx == self.recv_eidx:
             return []
-        idx, msg_list = parsefunc(self.recv_buf, max_msg, stop)
+        data = memoryview(self.recv_buf)[self.recv_sidx:self.recv_eidx]
+        idx, msg_list = parsefunc(data, max_msg, stop)
         if msg_list:
-            self.recv_buf = self.recv_buf[idx:]
+            self.recv_sidx += idx
         return msg_list
     # ػʣٸֽûз͡msg_listΪᷢϴʣµݡ
     def _write_x_msgs(self, msgs_type, msg_list=()):
@@ -103,13 +175,16 @@ class connbase():
                     print('%s: DataRow(%s)' % (prefix_str, bytes(msg)));
                 else:
                     print('%s: %s' % (prefix_str, msg.to_msg(fe=not fe)))
+        self._queue_x_msgs(msgs_type, msg_list)
+        self._write()
+        return self.send_sz
+    # ֻϢŵͶУ
+    def _queue_x_msgs(self, msgs_type, msg_list):
         if msg_list:
             if type(msg_list) is msgs_type:
-                self.send_buf += bytes(msg_list)
+                self._queue_send_data(msg_list.data)
             else:
-                self.send_buf += b''.join(bytes(msg) for msg in msg_list)
-        self._write()
-        return len(self.send_buf)
+                self._queue_send_data(b''.join(bytes(msg) for msg in msg_list))
     # һֱֱϢΪֹ
     def _read_x_msgs_until_avail(self, read_msgs_func, max_msg=0, stop=None):
         msg_list = read_msgs_func(max_msg, stop)
@@ -122,7 +197,7 @@ class connbase():
         if msg_list:
             if not write_msgs_func(msg_list):
                 return
-        if not self.send_buf:
+        if not self.send_sz:
             return
         while write_msgs_func():
             self.pollout()
@@ -132,6 +207,15 @@ class connbase():
         return self._read_x_msgs(functools.partial(p.parse_pg_msg, fe=self.is_fe()), max_msg, stop)
     def write_msgs(self, msg_list=()):
         return self._write_x_msgs(p.MsgChunk, msg_list)
+    # ؽջеһϢsocketȡݡremoveΪFalse򲻰Ϣӽջɾ
+    def get_buffered_msg(self, remove=True):
+        data = memoryview(self.recv_buf)[self.recv_sidx:self.recv_eidx]
+        idx, msg_list = p.parse_pg_msg(data, 1, fe=self.is_fe())
+        if not msg_list:
+            return None
+        if remove:
+            self.recv_sidx += idx
+        return msg_list[0]
     def read_msgs_until_avail(self, max_msg=0, stop=None):
         return self._read_x_msgs_until_avail(self.read_msgs, max_msg, stop)
     def write_msgs_until_done(self, msg_list=()):
@@ -151,6 +235,8 @@ class connbase():
         return self._write_x_msgs_until_done(self.write_raw_msgs, raw_msg_list)
     def write_raw_msg(self, raw_msg):
         return self.write_raw_msgs((raw_msg,))
+    def queue_raw_msgs(self, raw_msg_list):
+        self._queue_x_msgs(p.RawMsgChunk, raw_msg_list)
     # context manager
     def __enter__(self):
         return self
@@ -166,18 +252,19 @@ class feconn(connbase):
     # ȡһϢ1SSLRequestôе2startup_msg
     def read_startup_msg(self):
         self._read()
-        if p.startup_msg_is_complete(self.recv_buf):
+        data = bytes(self.recv_buf[self.recv_sidx:self.recv_eidx])
+        if p.startup_msg_is_complete(data):
             try:
-                self.startup_msg = p.parse_startup_msg(self.recv_buf)
+                self.startup_msg = p.parse_startup_msg(data)
             except RuntimeError as ex:
                 raise pgfatal(None, 'RuntimeError: %s' % ex)
-            self.recv_buf = b''
+            self.recv_sidx = self.recv_eidx
             return self.startup_msg
         else:
             return None
     # յSSLRequestʱ򣬵øú߿ͻ˲֧SSL
     def write_no_ssl(self):
-        self.send_buf = b'N'
+        self._queue_send_data(b'N')
         self.write_msgs_until_done()
 # ڶȡstatup message
 class feconn4startup():
@@ -17,6 +17,8 @@ import struct
 import hashlib
 import collections
 import copy
+import array
+import itertools
 import mputils
 from pgparse import *
 
@@ -903,23 +905,85 @@ def has_msg(data, idx, *, fe=True):
     if data_len -idx < msg_len + 1:
         return 0
     return msg_len + 1
-# һidxmsg_idxs((idx,sz)б)
+# RawMsgChunkеϢλi(idx, sz)ϢdataģֻҪarray('q')ÿϢĿʼλ
+# ԼһϢĽλãÿϢ8ֽ((idx,sz)ԪбÿϢԼҪ100ֽ)
+# Ƭ飬عͬһMsgIdxs԰offset/limitȡһϢO(1)ģصidxƬĿʼλá
+class MsgIdxs():
+    __slots__ = ('offs', 'start', 'stop')
+    def __init__(self, offs=None, start=0, stop=None):
+        self.offs = array.array('q', (0,)) if offs is None else offs
+        self.start = start
+        self.stop = len(self.offs) - 1 if stop is None else stop
+    @classmethod
+    def from_sizes(cls, sz_iter):
+        offs = array.array('q', (0,))
+        offs.extend(itertools.accumulate(sz_iter))
+        return cls(offs)
+    # msg_idxs(idx,sz)УϢĲҴ0ʼ
+    @classmethod
+    def from_list(cls, msg_idxs):
+        if type(msg_idxs) is cls:
+            return msg_idxs
+        offs = array.array('q', (0,))
+        for idx, sz in msg_idxs:
+            if idx != offs[-1]:
+                raise ValueError('msg_idxs is not contiguous at %s' % idx)
+            offs.append(idx + sz)
+        return cls(offs)
+    def __len__(self):
+        return self.stop - self.start
+    def __getitem__(self, i):
+        if type(i) is slice:
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('MsgIdxs do not support extended slice')
+            return MsgIdxs(self.offs, self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('MsgIdxs index out of range')
+        offs, k = self.offs, self.start + i
+        return (offs[k] - offs[self.start], offs[k+1] - offs[k])
+    def __iter__(self):
+        offs = self.offs
+        base = offs[self.start]
+        for k in range(self.start, self.stop):
+            yield (offs[k] - base, offs[k+1] - offs[k])
+    def sizes(self):
+        offs = self.offs
+        return (offs[k+1] - offs[k] for k in range(self.start, self.stop))
+    # ϢܴС
+    def data_size(self):
+        return self.offs[self.stop] - self.offs[self.start]
+    def __add__(self, other):
+        base = self.offs[self.start]
+        if base == 0:
+            offs = self.offs[:self.stop+1]
+        else:
+            offs = array.array('q', (x - base for x in self.offs[self.start:self.stop+1]))
+        delta = offs[-1] - other.offs[other.start]
+        offs.extend(x + delta for x in other.offs[other.start+1:other.stop+1])
+        return MsgIdxs(offs)
+    def __repr__(self):
+        return '<MsgIdxs len=%d size=%d>' % (len(self), self.data_size())
+# һidxmsg_idxs(MsgIdxs)databytesmemoryview
 def _parse_pg_msg(data, max_msg=0, stop=None):
-    msg_idxs = []
+    offs = array.array('q', (0,))
     idx, cnt = 0, 0
+    if cutils:
+        cdata = data if type(data) is bytes else cutils.ffi.from_buffer(data)
     while True:
         if cutils:
-            msg_len = cutils.lib.has_msg(data, len(data), idx)
+            msg_len = cutils.lib.has_msg(cdata, len(data), idx)
         else:
             msg_len = has_msg(data, idx)
         if msg_len <= 0:
             break
-        msg_idxs.append((idx, msg_len))
         idx += msg_len
+        offs.append(idx)
 
         if stop:
-            x = msg_idxs[-1]
-            raw_msg = RawMsg(data, x[0], x[0]+x[1])
+            raw_msg = RawMsg(data, idx-msg_len, idx)
             if callable(stop):
                 if stop(raw_msg): break
             else:
@@ -927,7 +991,7 @@ def _parse_pg_msg(data, max_msg=0, stop=None):
         cnt += 1
         if max_msg > 0 and cnt >= max_msg:
             break
-    return idx, msg_idxs
+    return idx, MsgIdxs(offs)
 # ͬMsgChunk֮䲻dataMsgChunkʹõMsgdata
 # Msg.copyصmsgMsgChunk
 class MsgChunk():
@@ -996,8 +1060,8 @@ def parse_pg_msg(data, max_msg=0, stop=None, *, fe=True):
     if not msg_idxs:
         return idx, MsgChunk.Empty
     else:
-        return idx, MsgChunk(data[:idx], msg_idxs, msg_map)
-# ûparserawϢ
+        return idx, MsgChunk(bytes(data[:idx]), msg_idxs, msg_map)
+# ûparserawϢdataǽջmemoryviewbytes(rawmsg)/copyضݡ
 class RawMsg():
     def __init__(self, data, sidx=0, eidx=None):
         self.data = data
@@ -1008,26 +1072,27 @@ class RawMsg():
             self.eidx = len(self.data)
     @property
     def msg_type(self):
-        return self.data[self.sidx:self.sidx+1]
+        return bytes(self.data[self.sidx:self.sidx+1])
     def __len__(self):
         return self.eidx - self.sidx
     def __bytes__(self):
-        return self.data[self.sidx:self.eidx]
+        return bytes(self.data[self.sidx:self.eidx])
     def to_msg(self, *, fe):
         msg_map = MsgMeta.fe_msg_map if fe else MsgMeta.be_msg_map
-        return msg_map[self.msg_type[0]](self.data[self.sidx:self.eidx])
+        return msg_map[self.data[self.sidx]](bytes(self))
     def to_rawmsg(self):
         return self
     # صϢǶģκRawMsgChunkdata
     def copy(self):
         return RawMsg(bytes(self))
 # ͬRawMsgChunk֮䲻dataRawMsgChunkʹõRawMsgdata
+# ӶȡRawMsgChunkdataǽջmemoryviewҪڱĻ(ŵcache)Ӧõcopy
 class RawMsgChunk():
     def __init__(self, data, msg_idxs):
         self.data = data
-        self.msg_idxs = msg_idxs # list of (sidx, msg_len)
+        self.msg_idxs = MsgIdxs.from_list(msg_idxs) # MsgIdxsҲԴ(sidx, msg_len)б
         if self.msg_idxs:
-            eidx = self.msg_idxs[-1][0] + self.msg_idxs[-1][1]
+            eidx = self.msg_idxs.data_size()
             if eidx != len(self.data):
                 raise ValueError('data len(%s) != eidx(%s)' % (len(self.data), eidx))
     def __len__(self):
@@ -1041,10 +1106,8 @@ class RawMsgChunk():
             x_list = self.msg_idxs[idx]
             if not x_list:
                 return RawMsgChunk.Empty
-            total_sz = x_list[-1][0] + x_list[-1][1] - x_list[0][0]
-            sidx = x_list[0][0]
-            x_list = [(idx-sidx, sz) for idx, sz in x_list]
-            return RawMsgChunk(self.data[sidx:sidx+total_sz], x_list)
+            sidx = x_list.offs[x_list.start] - self.msg_idxs.offs[self.msg_idxs.start]
+            return RawMsgChunk(self.data[sidx:sidx+x_list.data_size()], x_list)
         else:
             x = self.msg_idxs[idx]
             return RawMsg(self.data, x[0], x[0]+x[1])
@@ -1052,7 +1115,7 @@ class RawMsgChunk():
         for x in self.msg_idxs:
             yield RawMsg(self.data, x[0], x[0]+x[1])
     def __bytes__(self):
-        return self.data
+        return bytes(self.data)
     def __add__(self, other):
         if type(other) is not RawMsgChunk:
             raise TypeError("unsupported operand type for +: 'RawMsgChunk' and '%s'" % type(other).__name__)
@@ -1060,22 +1123,30 @@ class RawMsgChunk():
             return other
         if not other:
             return self
-        other_sidx = len(self.data)
-        res_msg_idxs = copy.copy(self.msg_idxs)
-        res_msg_idxs.extend((other_sidx+idx, sz) for idx, sz in other.msg_idxs)
-        return RawMsgChunk(self.data+other.data, res_msg_idxs)
+        return RawMsgChunk(b''.join((self.data, other.data)), self.msg_idxs + other.msg_idxs)
+    # صchunkͽջdata
+    def copy(self):
+        return RawMsgChunk(bytes(self.data), self.msg_idxs)
+    # ϢͣÿϢһֽڡ
+    def msg_types(self):
+        mi = self.msg_idxs
+        base = mi.offs[mi.start]
+        offs = mi.offs[mi.start:mi.stop]
+        if base:
+            offs = (x - base for x in offs)
+        return bytes(map(self.data.__getitem__, offs))
     # һ첽Ϣchunkû첽Ϣ򷵻self
     def remove_async_msg(self):
-        if not self:
+        types = self.msg_types()
+        if not any(t in types for t in (MsgType.MT_NoticeResponse, MsgType.MT_NotificationResponse, MsgType.MT_ParameterStatus)):
             return self
         chunk_list = []
         sidx = 0
-        for idx, mi in enumerate(self.msg_idxs):
-            msg_type = self.data[mi[0]:mi[0]+1]
-            if not MsgType.is_async_msg(msg_type):
+        for idx in range(len(types)):
+            if not MsgType.is_async_msg(types[idx:idx+1]):
                 continue
-            chun_list.append(self[sidx:idx])
-            sidx += 1
+            chunk_list.append(self[sidx:idx])
+            sidx = idx + 1
         chunk_list.append(self[sidx:])
         if len(chunk_list) == 1:
             return chunk_list[0]
@@ -1087,13 +1158,7 @@ class RawMsgChunk():
     @classmethod
     def join(cls, raw_msg_list):
         data = b''.join(bytes(m) for m in raw_msg_list)
-        msg_idxs = []
-        sidx = 0
-        for m in raw_msg_list:
-            sz = len(m)
-            msg_idxs.append((sidx, sz))
-            sidx += sz
-        return cls(data, msg_idxs)
+        return cls(data, MsgIdxs.from_sizes(len(m) for m in raw_msg_list))
 RawMsgChunk.Empty = RawMsgChunk(b'', [])
 # dataȡrawϢһidxRawMsgChunkúparseFEBEĵһϢ
 def parse_raw_pg_msg(data, max_msg=0, stop=None):
@@ -21,11 +21,49 @@ all = {
     # cache
     'cache_threshold_to_file' : 10*1024, 
     'cache_root_dir' : 'querycache', 
+    # ڴкͱļеĻܴСޣʱLRṶ0ʾޡ
+    'cache_max_bytes' : 0, 
+    'cache_max_disk_bytes' : 0, 
+    # ѹĽ(zlib/bz2/lzmaNoneʾѹ)ȡʱֻѹҪĿ飬cache_compress_blockÿԭʼС
+    'cache_compress' : None, 
+    'cache_compress_block' : 64*1024, 
+    # ׼: ѯcache_admit_count(0ʾ)ִʱ䲻Сcache_admit_build_timeĽŻ档
+    'cache_admit_count' : 0, 
+    'cache_admit_build_time' : 0, 
+    # ÿں̨ɾʱĻ
+    'cache_expire_interval' : 1, 
+    # ûעָtʱsqlԶصıڻջ档
+    'cache_auto_tables' : False, 
+    # ΪNoneʱLISTENchannelͨNOTIFYͱ޸ĵı(ŷָ)յصĻ棬cache_notify_batchڵ֪ͨϲ
+    'cache_notify_channel' : None, 
+    'cache_notify_batch' : 0.1, 
+    # ҳͨαÿFETCH¼0ʾһζȡp:nָȫ¼
+    'cache_page_fetch' : 1000, 
+    # ԤȻĲѯбļ(queries = [(database, user, sql), ...])worker֮ںִ̨Ул֮Ԥȡ
+    # cache_warm_concurrencyʾÿstartup_msgͬʱִеԤȲѯcache_warm_timeoutʾԤȲѯĳʱʱ()
+    'cache_warm_file' : None, 
+    'cache_warm_concurrency' : 2, 
+    'cache_warm_timeout' : 300, 
+    # cache_backend=localʾÿԼĻ棻shmʾͬһ̨ϵӳؽ̹cache_shm_sizeСĹڴ滺档
+    'cache_backend' : 'local', 
+    'cache_shm_name' : 'querycache', 
+    'cache_shm_size' : 64*1024*1024, 
     # ӿϢ
     # worker_min_cntеidxֵʾidx+1ǰʱҪworkerworker_per_fe_cntʾÿٸǰҪһӡ
     'worker_min_cnt' : [1]*2 + [2]*4 + [3]*4, 
     'worker_per_fe_cnt' : 10, 
     'idle_timeout' : 60*60*24, 
+    # worker_mode=threadʾÿһ̣߳muxʾкһ߳ͨepoll
+    'worker_mode' : 'thread', 
+    # procs>1ʾprocsӽ̣ӽͨSO_REUSEPORTͬһ˿ڣ̸HA
+    'procs' : 1, 
+    # procs_dispatch=reuseportʾӽ̶˿ڣstartup_msgʾ̼˿ڣȻstartup_msgǰӴӽ̡
+    'procs_dispatch' : 'reuseport', 
+    # pipeline_max_msg>1ʾǰһη͵ĶQueryϢ(pipeline_max_msg)һַͬһworker˳ִС
+    'pipeline_max_msg' : 1, 
+    # fe_spool_threshold>0ʾworkerȴǰ˽Ӧʣµ̷߳ͣǰ˷ͶгֵĲдfe_spool_dirµʱļ
+    'fe_spool_threshold' : 0, 
+    'fe_spool_dir' : None, 
     'master' : ('127.0.0.1', 5432), 
     'slaver' : [('127.0.0.1', 5433),], 
     # user_pwdsû룬ӿworkerЩӵӿ⡣ûauthmd5Ҫָ
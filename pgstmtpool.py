@@ -5,9 +5,9 @@
 # ʹֵParse/BindʱǰڷClose֮ǰ쳣Ͽˣô/portalᱻclose
 # ҪpypyбΪpypyĶ̺߳ȶʱʱ
 # 
-import sys, os, time, datetime
-import collections, socket, copy
-import threading, queue
+import sys, os, re, time, datetime, signal, mmap, json
+import collections, socket, copy, struct, array, heapq, itertools, bisect
+import threading, queue, importlib
 import pgnet
 import pgprotocol3 as p
 import pghba
@@ -16,18 +16,27 @@ import pseudodb
 import mputils
 import miscutils
 from pgmonitor import pgmonitor
+try:
+    import mysem, myshm
+except (ImportError, OSError): # Ҫcffi/posix_ipcԼlibmysem.soֻcache_backend=shmʱҪ
+    mysem = myshm = None
 
 # tablesбıԼsqlstrbytes
 # raw_msg_list is RawMsgChunk
 class CacheItem():
     threshold_to_file = 10*1024*1024
-    def __init__(self, timeout, tables, raw_msg_list, cfn):
+    complete = True # ǷȫֻPageCacheItemFalse
+    codec = None # ѹģ飬ֻZCacheItemNone
+    def __init__(self, timeout, stale_timeout, tables, raw_msg_list, cfn, build_time=0):
         self.timeout = timeout
+        self.stale_timeout = stale_timeout # timeoutûгstale_timeoutʱȻʹ(swr)
         self.tables = tables
-        self._raw_msg_list = raw_msg_list
+        self.build_time = build_time # Ӻ˻ý˶
+        self.hits = self.bytes_served = 0
+        self._raw_msg_list = raw_msg_list.copy() # ӵĽջ
         self.cache_fn = cfn
-        self.size = len(bytes(raw_msg_list))
-        self.raw_msg_idx_table = raw_msg_list.msg_idxs # list of (idx, sz)
+        self.size = len(self._raw_msg_list.data)
+        self.raw_msg_idx_table = raw_msg_list.msg_idxs # p.MsgIdxs
         self.rowdesc_raw_msg = raw_msg_list[0].copy()
         self._save_to_file_if()
     def _save_to_file_if(self):
@@ -43,110 +52,929 @@ class CacheItem():
         return len(self._raw_msg_list) if self._raw_msg_list else len(self.raw_msg_idx_table)
     def in_file(self):
         return self._raw_msg_list is None
+    # ͶпܻļmmapɾļӰû֮Զunmap
     def drop(self):
         if self.in_file():
             os.remove(self.cache_fn)
-    # Ϣ
+    # ϢļеϢֱmmapҪڴ棬͵ʱں˴page cache
     def get_raw_msg_list(self):
         if self._raw_msg_list:
             return self._raw_msg_list
+        return p.RawMsgChunk(self._mmap(), self.raw_msg_idx_table)
+    # ÿζȡmmapitemУΪmmapdupļļеitemܶʱᳬRLIMIT_NOFILE
+    # Ͷmmap֮unmapرļļڷ͵cache
+    def _mmap(self):
         with open(self.cache_fn, 'rb') as f:
-            return p.RawMsgChunk(f.read(), self.raw_msg_idx_table)
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
     # ָΧDataRow
     def get_datarow(self, offset, limit):
-        if self._raw_msg_list:
-            raw_msg_list = self._get_by_offsetlimit(self._raw_msg_list, offset, limit)
-            return raw_msg_list
-        raw_msg_idxs = self._get_by_offsetlimit(self.raw_msg_idx_table, offset, limit)
-        if not raw_msg_idxs:
-            return p.RawMsgChunk.Empty
-        sidx = raw_msg_idxs[0][0]
-        total_sz = raw_msg_idxs[-1][0] + raw_msg_idxs[-1][1] - raw_msg_idxs[0][0]
-        raw_msg_idxs = [(idx-sidx, sz) for idx, sz in raw_msg_idxs]
-        with open(self.cache_fn, 'rb') as f:
-            f.seek(sidx)
-            return p.RawMsgChunk(f.read(total_sz), raw_msg_idxs)
+        return self._get_by_offsetlimit(self.get_raw_msg_list(), offset, limit)
     def _get_by_offsetlimit(self, vs, offset, limit):
         start = offset + 1
         end = start + limit
         if end > len(vs) - 2:
             end = len(vs) - 2
         return vs[start:end]
+# ־ָļеcache itemһζȡʱŽϢ
+class FileCacheItem(CacheItem):
+    def __init__(self, timeout, stale_timeout, tables, cfn, size, msgcnt, build_time):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.tables = tables
+        self.build_time = build_time
+        self.hits = self.bytes_served = 0
+        self._raw_msg_list = None
+        self.cache_fn = cfn
+        self.size = size
+        self.msgcnt = msgcnt
+        self.raw_msg_idx_table = None
+        self.rowdesc_raw_msg = None
+    def msg_count(self):
+        return self.msgcnt
+    def get_raw_msg_list(self):
+        if self.raw_msg_idx_table is None:
+            raw_msg_list = p.parse_raw_pg_msg(self._mmap())[1]
+            self.rowdesc_raw_msg = raw_msg_list[0].copy()
+            self.raw_msg_idx_table = raw_msg_list.msg_idxs
+            return raw_msg_list
+        return super().get_raw_msg_list()
+# cache_compressʹõѹģ飬compress/decompress
+def get_codec(name):
+    if name is None:
+        return None
+    if name not in ('zlib', 'bz2', 'lzma'):
+        raise ValueError('unsupported cache_compress: %s' % name)
+    return importlib.import_module(name)
+# ѹcache item(cache_compress)ڴлļСϢ˳ֳԭʼСԼΪcache_compress_blockĿ飬ı߽Ϣı߽磬
+# ÿ鵥ѹÿ<ԭʼС:I><ѹĴС:I><ѹ>block_offsÿеλãblock_msgsÿһϢ
+# (Ϣ)raw_msg_idx_tableǽѹϢget_datarowֻҪѹЩеĿ顣sizeѹĴС
+# ÿζȡҪѹѹʱ¼statsС־ָʱblocksΪNoneһζȡʱѹȫĿؽ
+class ZCacheItem(CacheItem):
+    FRAME = struct.Struct('=II')
+    def __init__(self, timeout, stale_timeout, tables, cfn, build_time, codec, stats, data, size, raw_size, msgcnt, blocks=None):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.tables = tables
+        self.build_time = build_time
+        self.hits = self.bytes_served = 0
+        self.cache_fn = cfn
+        self.codec, self.stats = codec, stats
+        self._data = data # Noneʾļ
+        self.size, self.raw_size, self.msgcnt = size, raw_size, msgcnt
+        self.block_offs = self.block_msgs = self.raw_msg_idx_table = self.rowdesc_raw_msg = None
+        if blocks:
+            self.block_msgs, self.raw_msg_idx_table, self.rowdesc_raw_msg, self.block_offs = blocks
+    def msg_count(self):
+        return self.msgcnt
+    def in_file(self):
+        return self._data is None
+    def _get_data(self):
+        return self._mmap() if self._data is None else self._data
+    def _decompress_block(self, data, off):
+        raw_len, clen = self.FRAME.unpack_from(data, off)
+        off += self.FRAME.size
+        return self.codec.decompress(data[off:off+clen])
+    # ѹi鵽j-1飬ЩеϢ
+    def _decompress(self, i, j):
+        data = self._get_data()
+        t = time.time()
+        raw = b''.join(self._decompress_block(data, self.block_offs[k]) for k in range(i, j))
+        self.stats.decompress_time += time.time() - t
+        return p.RawMsgChunk(raw, self.raw_msg_idx_table[self.block_msgs[i]:self.block_msgs[j]])
+    def _load_blocks(self):
+        if self.block_offs is not None:
+            return
+        data = self._get_data()
+        block_offs, block_msgs, sizes = [], [], array.array('q')
+        rowdesc_raw_msg = None
+        off = 0
+        while off < len(data):
+            block_offs.append(off)
+            block_msgs.append(len(sizes))
+            raw_msg_list = p.parse_raw_pg_msg(self._decompress_block(data, off))[1]
+            if rowdesc_raw_msg is None:
+                rowdesc_raw_msg = raw_msg_list[0].copy()
+            sizes.extend(raw_msg_list.msg_idxs.sizes())
+            off += self.FRAME.size + self.FRAME.unpack_from(data, off)[1]
+        block_msgs.append(len(sizes))
+        # block_offs߳̿block_offsΪNoneʱѾú
+        self.block_msgs, self.raw_msg_idx_table, self.rowdesc_raw_msg = block_msgs, p.MsgIdxs.from_sizes(sizes), rowdesc_raw_msg
+        self.block_offs = block_offs
+    def get_raw_msg_list(self):
+        self._load_blocks()
+        return self._decompress(0, len(self.block_offs))
+    def get_datarow(self, offset, limit):
+        self._load_blocks()
+        start = offset + 1
+        end = min(start + limit, self.msgcnt - 2)
+        if start >= end:
+            return p.RawMsgChunk.Empty
+        i = bisect.bisect_right(self.block_msgs, start) - 1
+        j = bisect.bisect_left(self.block_msgs, end)
+        base = self.block_msgs[i]
+        return self._decompress(i, j)[start-base:end-base]
+# ͨαķҳ(cache_page_fetch>0)workerִDECLARE ... WITH HOLDԼһFETCH֮ѯҳ
+# ѾFETCHķΧʱɳαworker(αĺ)FETCH cache_page_fetchУworkerӺ˶ȡһҳ
+# ֻDataRowÿFETCHĽΪһα棬ӵʱҪ֮ǰݡȫFETCH֮滻ͨCacheItem
+# itemɾ(ʱ/̭//滻)֮ɳαworkerִCLOSEfetchingʾworkerFETCH/CLOSE߳á
+class PageCacheItem(CacheItem):
+    complete = False
+    cursor_seq = itertools.count()
+    def __init__(self, timeout, stale_timeout, tables, qc, sql, msg, worker):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.tables = tables
+        self.build_time = 0
+        self.hits = self.bytes_served = 0
+        self.qc, self.sql, self.msg = qc, sql, msg # msgڱcacheQueryϢ(offset/limit)
+        self.worker = worker
+        self.cursor = b'pgstmtpool_pc_%d' % next(self.cursor_seq)
+        self.fetching, self.dropped = True, False
+        self.size = self.nrows = 0
+        self.segments = [] # RawMsgChunkбֻDataRow
+        self.seg_starts = [] # ÿεһек
+        self.rowdesc_raw_msg = None
+    def msg_count(self):
+        return self.nrows + 1
+    def in_file(self):
+        return False
+    def drop(self):
+        self.dropped = True
+        if self.cursor and not self.fetching:
+            self.worker.main_queue.put(('pagefetch', self))
+    # QueryCache.lockеásegmentsnrowsȡʱnrowsʲԽ硣
+    def append(self, rows):
+        self.segments.append(rows)
+        self.seg_starts.append(self.nrows)
+        self.size += len(rows.data)
+        self.nrows += len(rows)
+    def get_datarow(self, offset, limit):
+        end = min(offset + limit, self.nrows)
+        res = []
+        i = bisect.bisect_right(self.seg_starts, offset) - 1
+        while offset < end:
+            seg, start = self.segments[i], self.seg_starts[i]
+            n = min(end, start + len(seg)) - offset
+            res.append(seg[offset-start:offset-start+n])
+            offset += n
+            i += 1
+        return join_raw_msg_chunks(res) if len(res) > 1 else (res[0] if res else p.RawMsgChunk.Empty)
+    # ذȫRawMsgChunkֻȫFETCH֮á
+    def to_raw_msg_list(self):
+        cc_raw_msg = p.CommandComplete(tag=b'SELECT %d' % self.nrows).to_rawmsg()
+        return join_raw_msg_chunks([p.RawMsgChunk(bytes(self.rowdesc_raw_msg), [(0, len(self.rowdesc_raw_msg))])] + self.segments + 
+                                   [p.RawMsgChunk(bytes(cc_raw_msg) + bytes(p.ReadyForQuery.Idle.to_rawmsg()), [(0, len(cc_raw_msg)), (len(cc_raw_msg), 6)])])
+# ѶRawMsgChunkϲһֻһݡ
+def join_raw_msg_chunks(chunk_list):
+    data = b''.join(bytes(chunk.data) for chunk in chunk_list)
+    return p.RawMsgChunk(data, p.MsgIdxs.from_sizes(itertools.chain.from_iterable(chunk.msg_idxs.sizes() for chunk in chunk_list)))
+# ڴӺ˶ȡ(ͬʱתǰ)ʱα棬ҪȫڴУҲΪ+=֮ǰݡ
+# СﵽCacheItem.threshold_to_file֮ǰÿζchunkﵽ֮Ǻ֮дcache_dirеʱļڴֻÿϢĴС
+# QueryCache.putʱʱļΪcacheļcacheļģܻ߳ʱabortɾʱļ
+# cache_dirΪNoneʱֻڴ(ShmQueryCacheԼҳFETCH)Сmax_size(0ʾ)ʱݲҲ档
+# 첽ϢӵʱɾcacheableʾǷԻ: ûErrorResponseCommandCompleteSELECT״̬idle
+# ָcodecʱÿblock_sizeѹһ(μZCacheItem)ѹĴСﵽthreshold_to_fileʱдʱļ
+# һĽѹѹʱѹǰĴС¼statsС
+class CacheWriter():
+    tmp_seq = itertools.count()
+    def __init__(self, cache_dir=None, max_size=0, codec=None, block_size=0, stats=None):
+        self.cache_dir, self.max_size = cache_dir, max_size
+        self.codec, self.block_size, self.stats = codec, block_size, stats
+        self.tmp_fn = self.f = None
+        self.chunks = [] # ڴеRawMsgChunkб
+        self.msg_sizes = array.array('q') # ļ(Ѿѹ)ÿϢĴС
+        self.size = 0 # ԭʼС
+        self.pending, self.pending_size = [], 0 # ûѹRawMsgChunkб
+        self.frames = [] # ڴеѹ
+        self.csize = 0 # ѹĴС
+        self.block_offs, self.block_msgs = [], []
+        self.rowdesc_raw_msg = None
+        self.cacheable, self.dropped = True, False
+    def in_file(self):
+        return self.f is not None
+    def append(self, raw_msg_list):
+        if self.dropped:
+            return
+        raw_msg_list = raw_msg_list.remove_async_msg()
+        if not raw_msg_list:
+            return
+        # 󲿷ϢDataRowͲϢ
+        types = raw_msg_list.msg_types()
+        if p.MsgType.MT_ErrorResponse in types:
+            self.cacheable = False
+        idx = types.find(p.MsgType.MT_CommandComplete)
+        while idx >= 0:
+            if not bytes(raw_msg_list[idx].to_msg(fe=False).tag).startswith(b'SELECT'):
+                self.cacheable = False
+            idx = types.find(p.MsgType.MT_CommandComplete, idx + 1)
+        if types.endswith(p.MsgType.MT_ReadyForQuery) and raw_msg_list[-1].to_msg(fe=False).trans_status != p.TransStatus.TS_Idle:
+            self.cacheable = False
+        if self.rowdesc_raw_msg is None:
+            self.rowdesc_raw_msg = raw_msg_list[0].copy()
+        self.size += len(raw_msg_list.data)
+        try:
+            if self.codec:
+                self._add_blocks(raw_msg_list)
+            elif self.f is not None:
+                self.f.write(raw_msg_list.data)
+                self.msg_sizes.extend(raw_msg_list.msg_idxs.sizes())
+            else:
+                self.chunks.append(raw_msg_list.copy())
+                if self.cache_dir and self.size >= CacheItem.threshold_to_file:
+                    self._to_file()
+        except OSError as ex:
+            print('CacheWriter write fail: %s' % (ex,))
+            self._drop()
+        if self.max_size > 0 and self.size > self.max_size:
+            self._drop()
+    # ʱļаpidQueryCache._load_indexдʱļ
+    def _to_file(self):
+        self.tmp_fn = os.path.join(self.cache_dir, 'tmp.%d.%d' % (os.getpid(), next(self.tmp_seq)))
+        self.f = open(self.tmp_fn, 'wb')
+        for chunk in self.chunks:
+            self.f.write(chunk.data)
+            self.msg_sizes.extend(chunk.msg_idxs.sizes())
+        self.f.writelines(self.frames)
+        self.chunks, self.frames = [], []
+    # ϢӵpendingУÿpendingĴСﵽblock_sizeϢ߽紦пѹ
+    def _add_blocks(self, raw_msg_list):
+        while raw_msg_list:
+            mi = raw_msg_list.msg_idxs
+            k = bisect.bisect_left(mi.offs, mi.offs[mi.start] + self.block_size - self.pending_size, mi.start + 1, mi.stop + 1)
+            if k > mi.stop:
+                self.pending.append(raw_msg_list.copy())
+                self.pending_size += len(raw_msg_list.data)
+                return
+            self.pending.append(raw_msg_list[:k-mi.start])
+            self._flush_block()
+            raw_msg_list = raw_msg_list[k-mi.start:]
+    def _flush_block(self):
+        raw = b''.join(bytes(chunk.data) for chunk in self.pending)
+        t = time.time()
+        cdata = self.codec.compress(raw)
+        self.stats.compressed(len(raw), len(cdata), time.time() - t)
+        self.block_offs.append(self.csize)
+        self.block_msgs.append(len(self.msg_sizes))
+        for chunk in self.pending:
+            self.msg_sizes.extend(chunk.msg_idxs.sizes())
+        self.pending, self.pending_size = [], 0
+        frame = ZCacheItem.FRAME.pack(len(raw), len(cdata))
+        self.csize += len(frame) + len(cdata)
+        if self.f is not None:
+            self.f.write(frame)
+            self.f.write(cdata)
+            return
+        self.frames += (frame, cdata)
+        if self.cache_dir and self.csize >= CacheItem.threshold_to_file:
+            self._to_file()
+    def _drop(self):
+        self.abort()
+        self.cacheable, self.dropped = False, True
+    # ڴеȫϢ
+    def raw_msg_list(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+        return join_raw_msg_chunks(self.chunks) if self.chunks else p.RawMsgChunk.Empty
+    # QueryCache.putеãļеĽɾɵitem֮ŸΪcfnΪitemdropɾcfn
+    def to_item(self, timeout, stale_timeout, tables, cfn, build_time):
+        if self.codec:
+            if self.block_offs:
+                return self._to_zitem(timeout, stale_timeout, tables, cfn, build_time)
+            self.chunks = self.pending
+        if self.f is None:
+            return CacheItem(timeout, stale_timeout, tables, self.raw_msg_list(), cfn, build_time)
+        self.f.close()
+        self.f = None
+        os.replace(self.tmp_fn, cfn)
+        self.tmp_fn = None
+        item = FileCacheItem(timeout, stale_timeout, tables, cfn, self.size, len(self.msg_sizes), build_time)
+        item.raw_msg_idx_table = p.MsgIdxs.from_sizes(self.msg_sizes)
+        item.rowdesc_raw_msg = self.rowdesc_raw_msg
+        return item
+    def _to_zitem(self, timeout, stale_timeout, tables, cfn, build_time):
+        if self.pending:
+            self._flush_block()
+        blocks = (self.block_msgs + [len(self.msg_sizes)], p.MsgIdxs.from_sizes(self.msg_sizes), self.rowdesc_raw_msg, self.block_offs)
+        data = None
+        if self.f is None:
+            data = b''.join(self.frames)
+        else:
+            self.f.close()
+            self.f = None
+            os.replace(self.tmp_fn, cfn)
+            self.tmp_fn = None
+        return ZCacheItem(timeout, stale_timeout, tables, cfn, build_time, self.codec, self.stats, data, self.csize, self.size, len(self.msg_sizes), blocks)
+    # ɾûзŵcacheеʱļԶε
+    def abort(self):
+        self.chunks, self.pending, self.frames = [], [], []
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.tmp_fn is not None:
+            try:
+                os.remove(self.tmp_fn)
+            except OSError:
+                pass
+            self.tmp_fn = None
+# ÿQueryCacheͳϢpseudo dbcache statshitsswrڼstale_hitsmissesexpired_misses(itemѾʱ)
+# QueryCache.getеļи£̵߳ʱ
+class CacheStats():
+    def __init__(self):
+        self.hits = self.stale_hits = self.misses = self.expired_misses = 0
+        self.mem_bytes_served = self.file_bytes_served = 0
+        self.builds = self.build_time = 0
+        self.evicted = self.rejected = 0
+        self.compress_in = self.compress_out = 0 # ѹǰֽ
+        self.compress_time = self.decompress_time = 0
+    def get(self, item, now):
+        if item.timeout > now:
+            self.hits += 1
+        elif item.stale_timeout > now:
+            self.hits += 1
+            self.stale_hits += 1
+        else:
+            self.misses += 1
+            self.expired_misses += 1
+    def served(self, item, nbytes):
+        item.hits += 1
+        item.bytes_served += nbytes
+        if item.in_file():
+            self.file_bytes_served += nbytes
+        else:
+            self.mem_bytes_served += nbytes
+    def built(self, build_time):
+        self.builds += 1
+        self.build_time += build_time
+    def compressed(self, nin, nout, t):
+        self.compress_in += nin
+        self.compress_out += nout
+        self.compress_time += t
+# single-flight: ûеʱ򣬵һworkerִвѯѯͬһsqlworkerȴȻ´ӻȡ
+# ߳workerͨwaitȴmux workerͨadd_callbackڽʱ֪ͨengine
+class CacheFlight(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.callbacks = []
+class CacheFlights():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {} # sql -> CacheFlight
+    # NoneʾҪִвѯִ֮end򷵻ҪȴCacheFlight
+    @mputils.AutoLock
+    def begin(self, sql):
+        flight = self.flights.get(sql, None)
+        if flight is None:
+            self.flights[sql] = CacheFlight()
+        return flight
+    @mputils.AutoLock
+    def end(self, sql):
+        flight = self.flights.pop(sql, None)
+        if flight:
+            flight.set()
+            for cb in flight.callbacks:
+                cb()
+    # flightʱcbѾϵá
+    @mputils.AutoLock
+    def add_callback(self, flight, cb):
+        if flight.is_set():
+            cb()
+        else:
+            flight.callbacks.append(cb)
+# TinyLFU׼QueryCacheֻڳQueryCache.lockʱácount-min sketch¼ѯ(QueryCache.get)
+# Ĵmin_count>0ʱֻдmin_countִʱ䲻Сmin_build_time(0ʾִʱ)ĽŷŵУ
+# ִֻһεĲѯռû(رǱļ)Ҳ̭õĽӼʱֻСļ(conservative update)
+# ܴﵽsample_size֮м룬ǰƵʻ˥
+class CacheAdmission():
+    depth = 4
+    def __init__(self, width=64*1024):
+        self.width = width
+        self.sample_size = width * 10
+        self.min_count = 0
+        self.min_build_time = 0
+        self.rows = [array.array('H', bytes(2*width)) for _ in range(self.depth)]
+        self.additions = 0
+    def _idxs(self, key):
+        return [hash((i, key)) % self.width for i in range(self.depth)]
+    def add(self, key):
+        if self.min_count <= 0:
+            return
+        idxs = self._idxs(key)
+        cnt = min(row[idx] for row, idx in zip(self.rows, idxs))
+        if cnt < 0xffff:
+            for row, idx in zip(self.rows, idxs):
+                if row[idx] == cnt:
+                    row[idx] = cnt + 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [array.array('H', (x >> 1 for x in row)) for row in self.rows]
+            self.additions //= 2
+    def estimate(self, key):
+        return min(row[idx] for row, idx in zip(self.rows, self._idxs(key)))
+    def admit(self, key, build_time):
+        if self.min_count <= 0:
+            return True
+        if self.min_build_time > 0 and build_time >= self.min_build_time:
+            return True
+        return self.estimate(key) > self.min_count
+# QueryCacheLRUCacheItem.sizeֱͳڴļеĻСmax_bytes/max_disk_bytes(0ʾ)ʱ
+# ̭ûʹõitemֻڳQueryCache.lockʱá
+class CacheLRU():
+    def __init__(self):
+        self.items = collections.OrderedDict() # (QueryCache, sql) -> CacheItemʹõ
+        self.max_bytes = self.max_disk_bytes = 0
+        self.mem_bytes = self.disk_bytes = 0
+    def add(self, qc, sql, item):
+        self.items[(qc, sql)] = item
+        if item.in_file():
+            self.disk_bytes += item.size
+        else:
+            self.mem_bytes += item.size
+    def remove(self, qc, sql):
+        item = self.items.pop((qc, sql))
+        if item.in_file():
+            self.disk_bytes -= item.size
+        else:
+            self.mem_bytes -= item.size
+    def touch(self, qc, sql):
+        self.items.move_to_end((qc, sql))
+    def grow(self, item, n):
+        if item.in_file():
+            self.disk_bytes += n
+        else:
+            self.mem_bytes += n
+    # Ҫ̭(QueryCache, sql)бûʹõĿʼ
+    def victims(self):
+        res = []
+        mem_over = self.mem_bytes - self.max_bytes if self.max_bytes > 0 else 0
+        disk_over = self.disk_bytes - self.max_disk_bytes if self.max_disk_bytes > 0 else 0
+        for key, item in self.items.items():
+            if mem_over <= 0 and disk_over <= 0:
+                break
+            if item.in_file():
+                if disk_over > 0:
+                    res.append(key)
+                    disk_over -= item.size
+            elif mem_over > 0:
+                res.append(key)
+                mem_over -= item.size
+        return res
 class QueryCache():
+    page_cursor = True # ֧PageCacheItem
     root_dir = 'querycache'
+    codec = None # cache_compressӦѹģ飬Noneʾѹ
+    compress_block = 64*1024
+    lru = CacheLRU()
+    admission = CacheAdmission()
+    lock = threading.Lock() # QueryCacheһΪLRṶʱɾQueryCacheеitem
+    # stale_timeoutĶѣԪ(stale_timeout, seq, QueryCache, sql)pgmiscworkerڵexpireɾʱitem
+    # itemɾ滻еԪزɾexpireʱ
+    expire_heap = []
+    expire_seq = itertools.count()
+    expire_batch = 100
+    expired_cnt = expired_bytes = 0
+    index_compact_min = 1000
     def __init__(self, cache_dir):
         self.cache_dir = os.path.abspath(os.path.join(self.root_dir, cache_dir))
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
         self.cached_items = {} # sql -> CacheItem
         self.t2sqls_map = collections.defaultdict(set) # table -> sql set
-        self.lock = threading.Lock()
+        self.flights = CacheFlights()
+        self.stats = CacheStats()
+        self.index_fn = os.path.join(self.cache_dir, 'index')
+        self.index_f = None
+        self.index_cnt = 0 # ־еļ¼
+        self.index_live = 0 # ļеitem
+        with self.lock:
+            self._load_index()
+    # ־(<cache_dir>/index)ָļеitemڴеitem¼ÿһjson¼:
+    #   .) {"sql":..., "fn":..., "timeout":..., "stale_timeout":..., "tables":[...], "size":..., "msgcnt":...} : item
+    #   .) {"rm":sql} : ɾitem
+    # дcacheļӼ¼ɾ¼ɾļԽ̱ûм¼ļһпܲԡ
+    # ʱָûгʱļСһµitemɾļ(ɾдʱļ)Ȼд־м¼index_compact_min
+    # ҳļitem2ʱҲд
+    def _load_index(self):
+        records = {}
+        try:
+            with open(self.index_fn, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'rm' in r:
+                        records.pop(r['rm'], None)
+                    else:
+                        records[r['sql']] = r
+        except FileNotFoundError:
+            pass
+        now = time.time()
+        for sql, r in records.items():
+            cfn = os.path.join(self.cache_dir, r['fn'])
+            try:
+                if r['stale_timeout'] <= now or os.path.getsize(cfn) != r['size']:
+                    continue
+            except OSError:
+                continue
+            if 'codec' in r:
+                item = ZCacheItem(r['timeout'], r['stale_timeout'], tuple(r['tables']), cfn, r.get('build_time', 0), get_codec(r['codec']), self.stats, 
+                                  None, r['size'], r['raw_size'], r['msgcnt'])
+            else:
+                item = FileCacheItem(r['timeout'], r['stale_timeout'], tuple(r['tables']), cfn, r['size'], r['msgcnt'], r.get('build_time', 0))
+            self.cached_items[sql] = item
+            for t in item.tables:
+                self.t2sqls_map[t].add(sql)
+            self.lru.add(self, sql, item)
+            heapq.heappush(self.expire_heap, (item.stale_timeout, next(self.expire_seq), self, sql))
+        fns = set(os.path.basename(item.cache_fn) for item in self.cached_items.values())
+        for fn in os.listdir(self.cache_dir):
+            if fn not in fns and fn != 'index' and not self._is_live_tmp(fn):
+                os.remove(os.path.join(self.cache_dir, fn))
+        if self.cached_items:
+            print('QueryCache: load %d items from %s' % (len(self.cached_items), self.cache_dir))
+        self._rewrite_index()
+        for qc, sql in self.lru.victims():
+            qc._remove(sql)
+    # ʱļtmp.<pid>.<seq>Ľ̻ڵʱ򷵻TrueеQueryCache_load_index֮Żдʱļ
+    # pidǱ̵ʱļ֮ǰĽµ(pid)
+    @staticmethod
+    def _is_live_tmp(fn):
+        parts = fn.split('.')
+        if len(parts) != 3 or parts[0] != 'tmp' or not parts[1].isdigit():
+            return False
+        pid = int(parts[1])
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+    def _index_record(self, sql, item):
+        r = {'sql':sql, 'fn':os.path.basename(item.cache_fn), 'timeout':item.timeout, 'stale_timeout':item.stale_timeout, 
+             'tables':item.tables, 'size':item.size, 'msgcnt':item.msg_count(), 'build_time':item.build_time}
+        if item.codec:
+            r['codec'], r['raw_size'] = item.codec.__name__, item.raw_size
+        return r
+    def _rewrite_index(self):
+        if self.index_f:
+            self.index_f.close()
+            self.index_f = None
+        try:
+            tmp_fn = self.index_fn + '.tmp'
+            with open(tmp_fn, 'w', encoding='utf8') as f:
+                cnt = 0
+                for sql, item in self.cached_items.items():
+                    if item.in_file():
+                        f.write(json.dumps(self._index_record(sql, item)) + '\n')
+                        cnt += 1
+            os.replace(tmp_fn, self.index_fn)
+            self.index_f = open(self.index_fn, 'a', encoding='utf8')
+            self.index_cnt = self.index_live = cnt
+        except OSError as ex:
+            print('QueryCache rewrite index fail: %s' % (ex,))
+    def _append_index(self, r):
+        if self.index_f is None:
+            return
+        try:
+            self.index_f.write(json.dumps(r) + '\n')
+            self.index_f.flush()
+        except OSError as ex:
+            print('QueryCache append index fail: %s' % (ex,))
+        self.index_cnt += 1
+        if self.index_cnt > self.index_compact_min and self.index_cnt > self.index_live * 2:
+            self._rewrite_index()
     @mputils.AutoLock
     def __len__(self):
         return len(self.cached_items)
     @mputils.AutoLock
     def get_all(self):
         return list(self.cached_items.items())
-    # cache itemûлѾʱ򷵻None
+    # cache itemûлѾʱ򷵻Nonetimeoutûгstale_timeoutitemҲأɵжǷҪˢ¡
     @mputils.AutoLock
     def get(self, sql, decode):
         sql = decode(sql)
+        self.admission.add((self, sql))
         item = self.cached_items.get(sql, None)
         if item is None:
+            self.stats.misses += 1
             return None
-        if item.timeout > time.time():
+        now = time.time()
+        self.stats.get(item, now)
+        if item.stale_timeout > now:
+            self.lru.touch(self, sql)
             return item
         # timeouted
-        self.cached_items.pop(sql)
+        self._remove(sql)
+        return None
+    def _remove(self, sql):
+        item = self.cached_items.pop(sql)
         for t in item.tables:
-            self.t2sqls_map[t].remove(sql)
+            self.t2sqls_map[t].discard(sql)
+            if not self.t2sqls_map[t]:
+                del self.t2sqls_map[t]
+        self.lru.remove(self, sql)
+        if item.in_file():
+            self.index_live -= 1
+            self._append_index({'rm':sql})
         item.drop()
-        return None
-    # raw_msg_list is RawMsgChunk
+    def new_writer(self):
+        return CacheWriter(self.cache_dir, codec=self.codec, block_size=self.compress_block, stats=self.stats)
+    # writer is CacheWriterput֮writer.abort()ɾûʹõʱļ
     @mputils.AutoLock
-    def put(self, msg, raw_msg_list, decode, force=False):
+    def put(self, msg, writer, decode, force=False, build_time=0):
         sql = decode(bytes(msg.query))
         if not force:
             item = self.cached_items.get(sql, None)
             if item and item.timeout > time.time():
                 return
         timeout = msg._comment_info.cache + time.time()
+        stale_timeout = timeout + (msg._comment_info.swr or 0)
         tables = tuple(decode(t) for t in msg._comment_info.tables)
+        # ˢ/ҳ/Ԥ(force)ԼѾڻеĲҪ׼
+        if not force and sql not in self.cached_items and not self._admit(sql, build_time):
+            return
+        if sql in self.cached_items: # ɾɵģΪµitemܲļ
+            self._remove(sql)
         cfn = os.path.join(self.cache_dir, p.md5(sql.encode('utf8')).decode('ascii'))
-        self.cached_items[sql] = CacheItem(timeout, tables, raw_msg_list, cfn)
-        for t in tables:
+        self._add(sql, writer.to_item(timeout, stale_timeout, tables, cfn, build_time))
+        self.stats.built(build_time)
+    # ҳڷpagecache֮ǰãΪ߳cֻͬһsqlһpagecache
+    @mputils.AutoLock
+    def admit(self, sql, build_time):
+        return self._admit(sql, build_time)
+    def _admit(self, sql, build_time):
+        if self.admission.admit((self, sql), build_time):
+            return True
+        self.stats.rejected += 1
+        return False
+    # ֮ǰsqlӦitemѾɾ
+    def _add(self, sql, item):
+        self.cached_items[sql] = item
+        for t in item.tables:
             self.t2sqls_map[t].add(sql)
+        if item.in_file():
+            self.index_live += 1
+            self._append_index(self._index_record(sql, item))
+        self.lru.add(self, sql, item)
+        heapq.heappush(self.expire_heap, (item.stale_timeout, next(self.expire_seq), self, sql))
+        self._evict()
+    def _evict(self):
+        for qc, sql in self.lru.victims():
+            qc.stats.evicted += 1
+            qc._remove(sql)
+    # PageCacheItemһadd_page_rowsʱŷŵcacheСmsgǲoffset/limitQueryϢ
+    def new_page_item(self, msg, decode, worker):
+        timeout = msg._comment_info.cache + time.time()
+        stale_timeout = timeout + (msg._comment_info.swr or 0)
+        tables = tuple(decode(t) for t in msg._comment_info.tables)
+        return PageCacheItem(timeout, stale_timeout, tables, self, decode(bytes(msg.query)), msg, worker)
+    # PageCacheItemFETCHУFalseʾitemѾɾ
+    @mputils.AutoLock
+    def add_page_rows(self, item, rows):
+        if item.dropped:
+            return False
+        item.append(rows)
+        if self.cached_items.get(item.sql) is item:
+            self.lru.grow(item, len(rows.data))
+            self._evict()
+        else:
+            if item.sql in self.cached_items:
+                self._remove(item.sql)
+            self._add(item.sql, item)
+        return not item.dropped
+    # sqlӦitemitemôɾ
+    @mputils.AutoLock
+    def remove_item(self, sql, item):
+        if self.cached_items.get(sql) is item:
+            self._remove(sql)
+    # expire_heapȡexpire_batchѾʱԪزɾӦitemȡԪظ
+    # ÿֻһ᳤ʱ
+    @classmethod
+    def expire(cls):
+        now = time.time()
+        cnt = 0
+        with cls.lock:
+            while cls.expire_heap and cls.expire_heap[0][0] <= now and cnt < cls.expire_batch:
+                timeout, seq, qc, sql = heapq.heappop(cls.expire_heap)
+                cnt += 1
+                item = qc.cached_items.get(sql, None)
+                if item is None or item.stale_timeout > now:
+                    continue
+                qc._remove(sql)
+                cls.expired_cnt += 1
+                cls.expired_bytes += item.size
+        return cnt
     @mputils.AutoLock
     def clear(self, tables, decode):
         tables = tuple(decode(t) for t in tables)
-        cleared_items = []
         for t in tables:
-            sqls = self.t2sqls_map.pop(t, None)
-            if not sqls:
+            for sql in list(self.t2sqls_map.get(t, ())):
+                self._remove(sql)
+    # кͱصcache
+    @mputils.AutoLock
+    def clear_all_tables(self):
+        for sql in set().union(*self.t2sqls_map.values()):
+            self._remove(sql)
+# λڹڴеcache itemݶڴС
+class ShmCacheItem(CacheItem):
+    def __init__(self, timeout, stale_timeout, tables, size, msgcnt, raw_msg_list=None):
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.tables = tables
+        self.build_time = 0
+        self.hits = self.bytes_served = 0
+        self.size = size
+        self.msgcnt = msgcnt
+        self._raw_msg_list = raw_msg_list
+        if raw_msg_list:
+            self.rowdesc_raw_msg = raw_msg_list[0]
+    def msg_count(self):
+        return self.msgcnt
+    def in_file(self):
+        return False
+    def drop(self):
+        pass
+# ڴеĲѯ(cache_backend=shm)ӿںQueryCacheһͬһ̨ϵӳؽ(ӳأ
+# Լģʽµӽ)һmysem.HashTableλΪcache_shm_nameposixڴУС̶
+# HashTableеkey: 
+#   .) <cache_dir>:q:<sql> : valueΪ <timeout:d> <stale_timeout:d> <tablesС:I> <Ϣ:I> <ϢݴС:Q> <tables> <ÿϢĴС:I*Ϣ> <Ϣ>
+#   .) <cache_dir>:t:<table> : valueΪ͸ñصsqlб\x00ָ
+# ڴʱɾгstale_timeoutitemǷŲ򲻻档
+# ڴڽ˳ȻڣҪõʱɾ/dev/shmµĹڴļźļ
+class ShmQueryCache():
+    page_cursor = False
+    hashtable = None # ʱopen_hashtable
+    blocksz = 4000
+    lock_timeout = 3 # źĽ쳣˳ôȴʱûcache
+    VALUE_HEADER = struct.Struct('=ddIIQ')
+    @classmethod
+    def open_hashtable(cls, name, size):
+        if not mysem:
+            raise RuntimeError('cache_backend=shm need cffi/posix_ipc and libmysem.so')
+        try:
+            shm = myshm.shm('pgstmtpool', name, size)
+            bucketnum = max(size // (cls.blocksz * 4), 1)
+            cls.hashtable = mysem.HashTable(shm.mm, bucketnum=bucketnum, blocksz=cls.blocksz)
+        except myshm.ipc.ExistentialError:
+            shm = myshm.shm('pgstmtpool', name, open_only=True)
+            cls.hashtable = mysem.HashTable(shm.mm, semvalue=None)
+        cls.shm = shm
+    def __init__(self, cache_dir):
+        self.prefix = cache_dir.encode('ascii') + b':'
+        self.flights = CacheFlights() # ֻϲеĲѯ
+        self.stats = CacheStats() # ֻͳƱ
+    def _qkey(self, sql):
+        return self.prefix + b'q:' + sql.encode('utf8')
+    def _tkey(self, table):
+        return self.prefix + b't:' + table.encode('utf8')
+    def __len__(self):
+        return len(self._sql_keys())
+    def _sql_keys(self):
+        qprefix = self.prefix + b'q:'
+        return [k for k in self.hashtable.keys(timeout=self.lock_timeout) if k.startswith(qprefix)]
+    def get_all(self):
+        res = []
+        hsz = self.VALUE_HEADER.size
+        for key in self._sql_keys():
+            v = self.hashtable.get(key, hsz, timeout=self.lock_timeout)
+            if not v:
                 continue
-            for sql in sqls:
-                cleared_items.append((sql, self.cached_items.pop(sql)))
-        for sql, item in cleared_items:
-            for t in item.tables:
-                try:
-                    self.t2sqls_map[t].remove(sql)
-                except KeyError:
-                    pass
-            item.drop()
-# commentʽ: /*s c:n p:n t:t1,t2,...,tn*/
-# sʾӴӿcָcacheޣpָҳ棻tָصı֮öŷָ
+            timeout, stale_timeout, tsz, msgcnt, size = self.VALUE_HEADER.unpack_from(v)
+            v = self.hashtable.get(key, hsz + tsz, timeout=self.lock_timeout)
+            if not v:
+                continue
+            tables = self._unpack_tables(v[hsz:])
+            res.append((key[len(self.prefix)+2:].decode('utf8'), ShmCacheItem(timeout, stale_timeout, tables, size, msgcnt)))
+        return res
+    def _unpack_tables(self, data):
+        return tuple(t.decode('utf8') for t in bytes(data).split(b'\x00')) if data else ()
+    # cache itemûлѾstale_timeout򷵻None
+    def get(self, sql, decode):
+        key = self._qkey(decode(sql))
+        try:
+            v = self.hashtable.get(key, timeout=self.lock_timeout)
+        except OSError as ex:
+            print('ShmQueryCache.get fail: %s' % (ex,))
+            return None
+        if v is None:
+            self.stats.misses += 1
+            return None
+        timeout, stale_timeout, tsz, msgcnt, size = self.VALUE_HEADER.unpack_from(v)
+        now = time.time()
+        self.stats.get(ShmCacheItem(timeout, stale_timeout, (), size, msgcnt), now)
+        if stale_timeout <= now:
+            self._remove(key)
+            return None
+        v = memoryview(v)
+        sidx = self.VALUE_HEADER.size
+        tables = self._unpack_tables(v[sidx:sidx+tsz])
+        sidx += tsz
+        sz_list = array.array('I')
+        sz_list.frombytes(v[sidx:sidx+msgcnt*sz_list.itemsize])
+        sidx += msgcnt * sz_list.itemsize
+        return ShmCacheItem(timeout, stale_timeout, tables, size, msgcnt, p.RawMsgChunk(v[sidx:], p.MsgIdxs.from_sizes(sz_list)))
+    # ֧׼
+    def admit(self, sql, build_time):
+        return True
+    # ڴ1/4СĽ棬Զȡʱ򳬹֮Ͳٱ
+    def new_writer(self):
+        return CacheWriter(max_size=self.hashtable.itemnum * self.blocksz // 4)
+    # writer is CacheWriter
+    def put(self, msg, writer, decode, force=False, build_time=0):
+        sql = decode(bytes(msg.query))
+        key = self._qkey(sql)
+        raw_msg_list = writer.raw_msg_list()
+        try:
+            if not force:
+                v = self.hashtable.get(key, self.VALUE_HEADER.size, timeout=self.lock_timeout)
+                if v and self.VALUE_HEADER.unpack_from(v)[0] > time.time():
+                    return
+            timeout = msg._comment_info.cache + time.time()
+            stale_timeout = timeout + (msg._comment_info.swr or 0)
+            tables = tuple(decode(t) for t in msg._comment_info.tables)
+            tdata = b'\x00'.join(t.encode('utf8') for t in tables)
+            sz_list = array.array('I', raw_msg_list.msg_idxs.sizes())
+            data = raw_msg_list.data
+            value = b''.join((self.VALUE_HEADER.pack(timeout, stale_timeout, len(tdata), len(sz_list), len(data)), tdata, sz_list.tobytes(), data))
+            # ̫item棬ÿζΪŲ¶ɨϣ
+            if len(value) > self.hashtable.itemnum * self.blocksz // 4:
+                return
+            if not self.hashtable.put(key, value, timeout=self.lock_timeout):
+                self._remove_timeouted()
+                if not self.hashtable.put(key, value, timeout=self.lock_timeout):
+                    return
+            self.stats.built(build_time)
+            for t in tables:
+                tkey = self._tkey(t)
+                sqls = self.hashtable.get(tkey, timeout=self.lock_timeout)
+                sqls = sqls.split(b'\x00') if sqls else []
+                if sql.encode('utf8') not in sqls:
+                    sqls.append(sql.encode('utf8'))
+                    self.hashtable.put(tkey, b'\x00'.join(sqls), timeout=self.lock_timeout)
+        except OSError as ex:
+            print('ShmQueryCache.put fail: %s' % (ex,))
+    def clear(self, tables, decode):
+        tables = tuple(decode(t) for t in tables)
+        try:
+            for t in tables:
+                tkey = self._tkey(t)
+                sqls = self.hashtable.get(tkey, timeout=self.lock_timeout)
+                if not sqls:
+                    continue
+                self.hashtable.remove(tkey, timeout=self.lock_timeout)
+                for sql in sqls.split(b'\x00'):
+                    self.hashtable.remove(self.prefix + b'q:' + sql, timeout=self.lock_timeout)
+        except OSError as ex:
+            print('ShmQueryCache.clear fail: %s' % (ex,))
+    def clear_all_tables(self):
+        tprefix = self.prefix + b't:'
+        try:
+            tables = [k[len(tprefix):] for k in self.hashtable.keys(timeout=self.lock_timeout) if k.startswith(tprefix)]
+        except OSError as ex:
+            print('ShmQueryCache.clear fail: %s' % (ex,))
+            return
+        self.clear(tables, lambda t: t.decode('utf8'))
+    def _remove(self, key):
+        try:
+            self.hashtable.remove(key, timeout=self.lock_timeout)
+        except OSError as ex:
+            print('ShmQueryCache.remove fail: %s' % (ex,))
+    # ɾгstale_timeoutitemstartup_msgitem
+    def _remove_timeouted(self):
+        now = time.time()
+        for key in self.hashtable.keys(timeout=self.lock_timeout):
+            if key.split(b':', 2)[1] != b'q':
+                continue
+            v = self.hashtable.get(key, self.VALUE_HEADER.size, timeout=self.lock_timeout)
+            if v and self.VALUE_HEADER.unpack_from(v)[1] <= now:
+                self.hashtable.remove(key, timeout=self.lock_timeout)
+# commentʽ: /*s c:n swr:n p:n t:t1,t2,...,tn*/
+# sʾӴӿcָcacheޣswrָcacheʱ֮󻹿ʹö룻pָҳ棻tָصı֮öŷָ
 # tablesǱбbytessqlҲbytes
 # c:nָ룬nָt:t1,t2,...,tnǱѯصıб
 # p[:n]ָҳʱȡ¼n<=0ָ߲ȡм¼sqlĽβoffset nn limit nnָcЧ
+# swr:nָcacheʱ֮nȻؾɵĽͬʱں̨ˢһcacheָcЧ
 # ûָcacheָtablesʱ򣬻Щصcache
-QueryCommentInfo = collections.namedtuple('QueryCommentInfo', 'master cache tables page offsetlimit msg_no_offsetlimit')
-QueryCommentInfo.NoComment = QueryCommentInfo(True, None, (), None, None, None)
+# auto_tables(cache_auto_tables)ΪTrueʱûָtôscan_query_tablessqlлtables: 
+# ָcĲѯFROM/JOINıѯ(ûע͵Ĳѯ)INSERT/UPDATE/DELETE/TRUNCATE/COPY FROM޸ĵı
+QueryCommentInfo = collections.namedtuple('QueryCommentInfo', 'master cache tables page offsetlimit msg_no_offsetlimit swr')
+QueryCommentInfo.NoComment = QueryCommentInfo(True, None, (), None, None, None, None)
+QueryCommentInfo.auto_tables = False
 def parse_query_comment(msg):
-    master, cache, tables = True, None, () 
+    if msg.msg_type == p.MsgType.MT_Parse:
+        return _parse_parse_comment(msg)
+    master, cache, tables, swr = True, None, (), None
     page, offsetlimit, msg_no_offsetlimit = None, None, None
     sql = bytes(msg.query).strip().strip(b';')
     if msg.msg_type != p.MsgType.MT_Query or sql[:2] != b'/*':
         msg._comment_info = QueryCommentInfo.NoComment
+        if QueryCommentInfo.auto_tables and msg.msg_type == p.MsgType.MT_Query:
+            tables = scan_query_tables(sql, write=True)
+            if tables:
+                msg._comment_info = QueryCommentInfo.NoComment._replace(tables=tables)
         return msg
     idx = sql.index(b'*/')
     info, sql = sql[2:idx], sql[idx+2:].strip()
@@ -162,6 +990,8 @@ def parse_query_comment(msg):
             cache = int(item[2:])
         elif item[:2] == b't:':
             tables = tuple(t for t in item[2:].split(b',') if t)
+        elif item[:4] == b'swr:':
+            swr = int(item[4:])
         else:
             raise RuntimeError('unknown item(%s) in comment' % item)
     if page is not None:
@@ -179,9 +1009,108 @@ def parse_query_comment(msg):
             raise RuntimeError('sql should be end with offset/limit while comment contain p')
         if cache is None:
             raise RuntimeError('comment should contain c while p is provided')
+    if swr is not None and cache is None:
+        raise RuntimeError('comment should contain c while swr is provided')
+    if QueryCommentInfo.auto_tables and not tables:
+        tables = scan_query_tables(sql, write=cache is None)
     msg = p.Query(query=sql)
-    msg._comment_info = QueryCommentInfo(master, cache, tables, page, offsetlimit, msg_no_offsetlimit)
+    msg._comment_info = QueryCommentInfo(master, cache, tables, page, offsetlimit, msg_no_offsetlimit, swr)
+    return msg
+# չѯЭParseϢע͵ĸʽQueryһǲ֧pParseϢ޸(עͻᷢ)
+# עдʱûעͣΪBind/Execute/SyncϢǰӵĽջУֱӷErrorResponse
+def _parse_parse_comment(msg):
+    try:
+        info = parse_query_comment(p.Query(query=msg.query))._comment_info
+    except Exception:
+        info = QueryCommentInfo.NoComment
+    if info.page is not None:
+        info = QueryCommentInfo.NoComment
+    msg._comment_info = info
     return msg
+# 򵥵sqlɨ裬﷨ֻcache_auto_tablesȥע/ַȻʽұ
+# schemaûŵıתСдõı(extract(x from col)еcol)ֻᵼ¶cache
+_SCAN_IDENT = rb'(?:"(?:[^"]|"")+"|[a-z_\x80-\xff][\w$\x80-\xff]*)'
+_SCAN_NAME = _SCAN_IDENT + rb'(?:\s*\.\s*' + _SCAN_IDENT + rb')*'
+_scan_strip_re = re.compile(rb"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/|\$(\w*)\$.*?\$\1\$", re.S)
+_scan_write_re = re.compile(rb'\b(insert\s+into|update|delete\s+from|truncate(?:\s+table)?|copy)\s+(?:only\s+)?(' + _SCAN_NAME + rb')', re.I)
+_scan_read_re = re.compile(rb'\b(from|join)\b', re.I)
+_scan_item_re = re.compile(rb'\s*(?:(?:only|lateral)\s+)?(' + _SCAN_NAME + rb')?(\s*\()?', re.I)
+_scan_alias_re = re.compile(rb'(?:\s+as)?\s+(' + _SCAN_IDENT + rb')(?:\s*\([^)]*\))?', re.I)
+_scan_next_re = re.compile(rb'\s*,\s*(?:only\s+)?(' + _SCAN_NAME + rb')', re.I)
+_scan_comma_re = re.compile(rb'\s*,')
+_scan_paren_re = re.compile(rb'[()]')
+_scan_copy_from_re = re.compile(rb'\s*(?:\([^)]*\)\s*)?from\b', re.I)
+_scan_not_update_re = re.compile(rb'\b(?:for|key|do)\s*$', re.I)
+_scan_keywords = frozenset(b'''select from where join inner left right full cross natural on using group order limit offset 
+    union intersect except having window for fetch returning set values lateral only as tablesample default do of nowait skip with'''.split())
+def _scan_table_name(name):
+    name = re.findall(_SCAN_IDENT, name, re.I)[-1]
+    if name[:1] == b'"':
+        return name[1:-1].replace(b'""', b'"')
+    return name.lower()
+# pos'('֮λãضӦ')'֮λ
+def _scan_skip_parens(sql, pos):
+    depth = 1
+    while depth:
+        m = _scan_paren_re.search(sql, pos)
+        if not m:
+            return len(sql)
+        depth += 1 if m.group() == b'(' else -1
+        pos = m.end()
+    return pos
+def scan_query_tables(sql, write):
+    sql = _scan_strip_re.sub(b' ', sql)
+    tables = []
+    if write:
+        for m in _scan_write_re.finditer(sql):
+            kind = m.group(1)[:2].lower()
+            if kind == b'up' and _scan_not_update_re.search(sql, max(m.start()-16, 0), m.start()):
+                continue
+            if kind == b'co' and not _scan_copy_from_re.match(sql, m.end()):
+                continue
+            tables.append(m.group(2))
+            if kind == b'tr':
+                pos = m.end()
+                while True:
+                    m2 = _scan_next_re.match(sql, pos)
+                    if not m2:
+                        break
+                    tables.append(m2.group(1))
+                    pos = m2.end(1)
+    else:
+        # FROMǶŷָı//ӲѯбJOINֻһӲѯеıfinditer
+        for m in _scan_read_re.finditer(sql):
+            pos = m.end()
+            while True:
+                m2 = _scan_item_re.match(sql, pos)
+                if m2.group(1) and m2.group(1).lower() in _scan_keywords:
+                    break
+                if m2.group(2) and not m2.group(1): # Ӳѯ(t1 join t2)
+                    m3 = _scan_item_re.match(sql, m2.end())
+                    if not m3.group(1) or m3.group(1).lower() not in _scan_keywords:
+                        pos = m2.end()
+                        continue
+                    pos = _scan_skip_parens(sql, m2.end())
+                elif m2.group(2): # 
+                    pos = _scan_skip_parens(sql, m2.end())
+                elif m2.group(1):
+                    tables.append(m2.group(1))
+                    pos = m2.end()
+                else:
+                    break
+                m2 = _scan_alias_re.match(sql, pos)
+                if m2 and m2.group(1).lower() not in _scan_keywords:
+                    pos = m2.end()
+                m2 = _scan_comma_re.match(sql, pos)
+                if not m2 or m.group(1).lower() != b'from':
+                    break
+                pos = m2.end()
+    res = []
+    for t in tables:
+        t = _scan_table_name(t)
+        if t.lower() not in _scan_keywords and t not in res:
+            res.append(t)
+    return tuple(res)
 
 class fepgfatal(Exception):
     def __init__(self, fatal_ex, last_fe_msg=None):
@@ -189,6 +1118,7 @@ class fepgfatal(Exception):
         self.last_fe_msg = None
 @mputils.generateid
 class pgstmtworker():
+    page_fetch = 1000 # cache_page_fetchҳÿFETCH
     def __init__(self, pool_id, be_addr, main_queue, max_msg=0):
         self.pool_id = pool_id
         self.be_addr = be_addr
@@ -207,8 +1137,23 @@ class pgstmtworker():
         self.idle_timeout = 600
         # ӶлõϢ
         self.last_msg = None
+        self.flight_sql = None # ǰworkerΪsingle-flightleaderִеsql
+        self.page_item = None # FETCH/CLOSEPageCacheItem
     def __repr__(self):
         return '<pgstmtworker pool_id=%s id=%s be_addr=%s>' % (self.pool_id, self.id, self.be_addr)
+    # ûеʱáNoneʾɵǰworkerִвѯ򷵻ҪȴCacheFlightҳ治ϲ
+    def _begin_flight(self, msg):
+        if msg._comment_info.page is not None:
+            return None
+        sql = self.becnn.decode(bytes(msg.query))
+        flight = self.query_cache.flights.begin(sql)
+        if flight is None:
+            self.flight_sql = sql
+        return flight
+    def _end_flight(self):
+        if self.flight_sql is not None:
+            self.query_cache.flights.end(self.flight_sql)
+            self.flight_sql = None
     def put(self, fecnn, msg):
         self.last_put_time = time.time()
         self.msg_queue.put_nowait((fecnn, msg, self.last_put_time))
@@ -251,9 +1196,7 @@ class pgstmtworker():
                 self.main_queue.put(('fail', fecnn, self, False))
             self.becnn.close()
             return
-        
-        exit_cause = self._process_loop()
-        self.main_queue.put(('exit', exit_cause, self))
+        self._after_auth()
     # Ҫǰ˲authؼֲָauthؼֲָhost/port
     def run2(self, kwargs):
         kwargs['host'] = self.be_addr[0]
@@ -267,7 +1210,9 @@ class pgstmtworker():
         self.startup_msg = self.becnn.startup_msg
         self.auth_ok_msgs = self.becnn.make_auth_ok_msgs()
         self.main_queue.put(('ok', None, self))
-        
+        self._after_auth()
+    # authɹ֮ڵǰ߳дϢ
+    def _after_auth(self):
         exit_cause = self._process_loop()
         self.main_queue.put(('exit', exit_cause, self))
     def _process_loop(self):
@@ -290,7 +1235,8 @@ class pgstmtworker():
                     self._process_msg(fecnn, self.last_msg)
                 done_time = time.time()
             except pgnet.pgfatal as ex:
-                fecnn.close()
+                if type(fecnn) is not tuple: # ûǰ
+                    fecnn.close()
                 print('<worker %d>: BE%s: %s' % (self.id, self.becnn.getpeername(), ex))
                 return 'befatal'
             else:
@@ -299,24 +1245,98 @@ class pgstmtworker():
     def _process_cmd(self, cmd):
         name, *args = cmd
         if name == 'pagecache':
-            self._process_cmd_pagecache(args[0])
+            msg, on_ready, writer = self._make_pagecache(args[0])
+        elif name == 'pagefetch':
+            msg, on_ready, writer = self._make_pagefetch(args[0])
         else:
-            print('<worker %d>: unknown cmd: %s' % name)
-    def _process_cmd_pagecache(self, femsg):
-        be_raw_msg_list = p.RawMsgChunk.Empty
-        sql = bytes(femsg._comment_info.msg_no_offsetlimit.query)
-        msg_no_offsetlimit = p.Query.make(sql)
-        if femsg._comment_info.page > 0:
-            sql = sql + b' limit %d' % femsg._comment_info.page
-        msg = p.Query.make(sql)
+            print('<worker %d>: unknown cmd: %s' % (self.id, name))
+            return
+        try:
+            on_ready(self._query_collect(msg, writer))
+        finally:
+            if writer:
+                writer.abort()
+            self._page_failed()
+    # ִвѯеĺϢӵwriter(ΪNoneʱ)writer
+    def _query_collect(self, msg, writer):
+        self.query_start = time.time()
         self.becnn.write_msgs_until_done((msg,))
         while True:
             raw_msg_list = self.becnn.read_raw_msgs_until_avail()
-            be_raw_msg_list += raw_msg_list
+            if writer:
+                writer.append(raw_msg_list)
             if raw_msg_list[-1].msg_type == p.MsgType.MT_ReadyForQuery:
                 break
+        return writer
+    # ط˵QueryϢյReadyForQuery֮Ĵ(writer)ԼϢCacheWriter
+    # cache_page_fetch>0ʱҳͨα䣬μPageCacheItem
+    def _make_pagecache(self, femsg):
+        msg, msg_no_offsetlimit = self._make_pagecache_msgs(femsg)
+        if femsg._comment_info.page is None or self.page_fetch <= 0 or not self.query_cache.page_cursor:
+            return msg, lambda writer: self._put_to_cache(writer, msg_no_offsetlimit, force=True), self.query_cache.new_writer()
+        item = self.query_cache.new_page_item(msg_no_offsetlimit, self.becnn.decode, self)
+        sql = b'DECLARE %s NO SCROLL CURSOR WITH HOLD FOR %s; FETCH FORWARD %d FROM %s' % (item.cursor, bytes(msg.query), self.page_fetch, item.cursor)
+        self.page_item = item
+        return p.Query.make(sql), lambda writer: self._page_fetched(item, writer), CacheWriter()
+    def _make_pagefetch(self, item):
+        self.page_item = item
+        if item.dropped:
+            return p.Query.make(b'CLOSE ' + item.cursor), lambda writer: self._page_closed(item), None
+        sql = b'FETCH FORWARD %d FROM %s' % (self.page_fetch, item.cursor)
+        return p.Query.make(sql), lambda writer: self._page_fetched(item, writer), CacheWriter()
+    def _page_closed(self, item):
+        item.cursor = None
+        item.fetching = False
+        self.page_item = None
+    # FETCH/CLOSEûִ(ӶϿ)ʱãαѾˣɾitem
+    # fetchingһֱTrue̲߳ٷַpagefetchitemֻܷѾFETCHҳֱʱ
+    def _page_failed(self):
+        item, self.page_item = self.page_item, None
+        if item is None:
+            return
+        item.cursor = None
+        item.fetching = False
+        self.query_cache.remove_item(item.sql, item)
+        item.drop()
+    def _page_fetched(self, item, writer):
+        item.build_time += time.time() - self.query_start
+        be_raw_msg_list = writer.raw_msg_list()
+        rowdesc_idx = cc_idx = None
+        for idx, m in enumerate(be_raw_msg_list):
+            msg_type = m.msg_type
+            if msg_type == p.MsgType.MT_ErrorResponse:
+                rowdesc_idx = None
+                break
+            elif msg_type == p.MsgType.MT_RowDescription:
+                rowdesc_idx = idx
+            elif msg_type == p.MsgType.MT_CommandComplete:
+                cc_idx = idx
+        if rowdesc_idx is None: # DECLAREʧܻαѾ
+            self.query_cache.remove_item(item.sql, item)
+            item.drop()
+        else:
+            if item.rowdesc_raw_msg is None:
+                item.rowdesc_raw_msg = be_raw_msg_list[rowdesc_idx].copy()
+            rows = be_raw_msg_list[rowdesc_idx+1:cc_idx].copy()
+            if self.query_cache.add_page_rows(item, rows) and len(rows) < self.page_fetch:
+                # ȫFETCH꣬滻ͨCacheItem(дļ)滻ʱɾitemȻCLOSEα
+                cache_writer = self.query_cache.new_writer()
+                cache_writer.append(item.to_raw_msg_list())
+                self._put_to_cache(cache_writer, item.msg, True, item.build_time)
+        item.fetching = False
+        self.page_item = None
+        if item.dropped:
+            item.drop()
+    # ط˵QueryϢ(p:nӦlimit)ڱcacheQueryϢǷҳʱ(swrˢ)߶femsg
+    def _make_pagecache_msgs(self, femsg):
+        if femsg._comment_info.page is None:
+            return femsg, femsg
+        sql = bytes(femsg._comment_info.msg_no_offsetlimit.query)
+        msg_no_offsetlimit = p.Query.make(sql)
         msg_no_offsetlimit._comment_info = femsg._comment_info
-        self._put_to_cache(be_raw_msg_list, msg_no_offsetlimit, force=True)
+        if femsg._comment_info.page > 0:
+            sql = sql + b' limit %d' % femsg._comment_info.page
+        return p.Query.make(sql), msg_no_offsetlimit
     def _process_msg(self, fecnn, msg):
         if msg.msg_type == p.MsgType.MT_Terminate:
             print('<worker %d>: recved Terminate from %s' % (self.id, fecnn.getpeername()))
@@ -332,26 +1352,45 @@ class pgstmtworker():
         if femsg._comment_info.cache:
             if self._process_from_cache(fecnn, femsg):
                 return
-        self.becnn.write_msgs_until_done((femsg,))
-        raw_msg_list = self.becnn.read_raw_msgs_until_avail()
-        m = raw_msg_list[0]
-        if m.msg_type == p.MsgType.MT_CopyInResponse:
-            self._process_copyin(fecnn, raw_msg_list)
-        elif m.msg_type == p.MsgType.MT_CopyOutResponse:
-            self._process_copyout(fecnn, raw_msg_list)
-        elif m.msg_type == p.MsgType.MT_CopyBothResponse:
-            raise pgnet.pgfatal(None, 'do not support CopyBothResponse')
-        else:
-            self._process_query2(fecnn, raw_msg_list)
+            flight = self._begin_flight(femsg)
+            if flight: # leaderĽûб()ôԼִвѯ
+                flight.wait()
+                if self._process_from_cache(fecnn, femsg):
+                    return
+        try:
+            self.query_start = time.time()
+            self._write_query(femsg)
+            raw_msg_list = self.becnn.read_raw_msgs_until_avail()
+            m = raw_msg_list[0]
+            if m.msg_type == p.MsgType.MT_CopyInResponse:
+                self._process_copyin(fecnn, raw_msg_list)
+            elif m.msg_type == p.MsgType.MT_CopyOutResponse:
+                self._process_copyout(fecnn, raw_msg_list)
+            elif m.msg_type == p.MsgType.MT_CopyBothResponse:
+                raise pgnet.pgfatal(None, 'do not support CopyBothResponse')
+            else:
+                self._process_query2(fecnn, raw_msg_list)
+        finally:
+            self._end_flight()
     def _process_from_cache(self, fecnn, femsg):
         if femsg._comment_info.page is not None:
             return self._process_from_cache_page(fecnn, femsg)
         sql = bytes(femsg.query)
         citem = self.query_cache.get(sql, self.becnn.decode)
-        if not citem:
+        if not citem or not citem.complete:
             return False
-        self._write_cached_msgs_to_fe(fecnn, citem.get_raw_msg_list())
+        try:
+            raw_msg_list = citem.get_raw_msg_list()
+        except FileNotFoundError: # get֮worker̭
+            return False
+        self._write_cached_msgs_to_fe(fecnn, raw_msg_list)
+        self.query_cache.stats.served(citem, len(raw_msg_list.data))
+        self._refresh_if_stale(citem, femsg, sql)
         return True
+    # cache itemѾʱ(swr)ôͨ߳ĳworkerں̨ˢcache̱֤߳ͬһsqlcֻˢһΡ
+    def _refresh_if_stale(self, citem, femsg, sql):
+        if citem.timeout <= time.time():
+            self.main_queue.put(('pagecache', self.startup_msg, femsg, self.becnn.decode(sql)))
     def _process_from_cache_page(self, fecnn, femsg):
         sql = bytes(femsg._comment_info.msg_no_offsetlimit.query)
         citem = self.query_cache.get(sql, self.becnn.decode)
@@ -359,51 +1398,64 @@ class pgstmtworker():
             return False
         page = femsg._comment_info.page
         offset, limit = femsg._comment_info.offsetlimit
-        datarow_list = citem.get_datarow(offset, limit)
+        if not citem.complete and offset + limit > citem.nrows:
+            # PageCacheItemѾFETCHķΧóαworkerFETCHһΣһҳӺ˶ȡҲ
+            self.main_queue.put(('pagefetch', citem))
+            femsg._comment_info = QueryCommentInfo.NoComment
+            return False
+        try:
+            datarow_list = citem.get_datarow(offset, limit)
+        except FileNotFoundError:
+            return False
         if page > 0 and not datarow_list:
             # offsetѾķΧôֱӴӺ˶ȡҲ棬൱ûָע
             femsg._comment_info = QueryCommentInfo.NoComment
             return False
         cc_raw_msg = p.CommandComplete(tag=b'SELECT %d' % len(datarow_list)).to_rawmsg()
         self._write_cached_msgs_to_fe(fecnn, (citem.rowdesc_raw_msg,), datarow_list, (cc_raw_msg, p.ReadyForQuery.Idle.to_rawmsg()))
+        self.query_cache.stats.served(citem, len(datarow_list.data))
+        self._refresh_if_stale(citem, femsg, sql)
         return True
     def _process_query2(self, fecnn, raw_msg_list):
+        writer = self._new_writer(self.last_msg)
+        try:
+            while True:
+                if writer:
+                    writer.append(raw_msg_list)
+                if self._write_msgs_to_fe(fecnn, raw_msg_list)[1]:
+                    break
+                raw_msg_list = self.becnn.read_raw_msgs_until_avail()
+            self._query_done(writer)
+        finally:
+            if writer:
+                writer.abort()
+    # ҪĲѯ(ҳ)CacheWriter򷵻None
+    def _new_writer(self, msg):
+        if msg._comment_info.cache and msg._comment_info.page is None:
+            return self.query_cache.new_writer()
+        return None
+    # յReadyForQuery֮󱣴cacheرcache
+    def _query_done(self, writer):
         cache = self.last_msg._comment_info.cache
         page = self.last_msg._comment_info.page
-        be_raw_msg_list = p.RawMsgChunk.Empty
-        if cache and page is None:
-            be_raw_msg_list += raw_msg_list
-        while True:
-            if self._write_msgs_to_fe(fecnn, raw_msg_list)[1]:
-                break
-            raw_msg_list = self.becnn.read_raw_msgs_until_avail()
-            if cache and page is None:
-                be_raw_msg_list += raw_msg_list
         if cache:
             if page is None:
-                self._put_to_cache(be_raw_msg_list, self.last_msg)
+                self._put_to_cache(writer, self.last_msg)
+                self._end_flight()
             else:
                 sql_no_offsetlimit = self.becnn.decode(bytes(self.last_msg._comment_info.msg_no_offsetlimit.query))
-                self.main_queue.put(('pagecache', self.startup_msg, self.last_msg, sql_no_offsetlimit))
+                if self.query_cache.admit(sql_no_offsetlimit, time.time() - self.query_start):
+                    self.main_queue.put(('pagecache', self.startup_msg, self.last_msg, sql_no_offsetlimit))
         elif self.last_msg._comment_info.tables:
             self.query_cache.clear(self.last_msg._comment_info.tables, self.becnn.decode)
-    def _put_to_cache(self, be_raw_msg_list, last_msg, force=False):
-        m = be_raw_msg_list[-1].to_msg(fe=False)
-        if m.trans_status != p.TransStatus.TS_Idle:
-            return
-        got_async_msg = False
-        for m in reversed(be_raw_msg_list):
-            msg_type = m.msg_type
-            if msg_type == p.MsgType.MT_ErrorResponse:
-                return
-            if msg_type == p.MsgType.MT_CommandComplete:
-                if not bytes(m.to_msg(fe=False).tag).startswith(b'SELECT'):
-                    return
-            if p.MsgType.is_async_msg(msg_type):
-                got_async_msg = True
-        if got_async_msg:
-            be_raw_msg_list = be_raw_msg_list.remove_async_msg()
-        self.query_cache.put(last_msg, be_raw_msg_list, self.becnn.decode)
+    def _put_to_cache(self, writer, last_msg, force=False, build_time=None):
+        if build_time is None:
+            build_time = time.time() - self.query_start
+        try:
+            if writer.cacheable:
+                self.query_cache.put(last_msg, writer, self.becnn.decode, force, build_time)
+        finally:
+            writer.abort()
     def _process_copyout(self, fecnn, raw_msg_list):
         while True:
             if self._write_msgs_to_fe(fecnn, raw_msg_list)[1]:
@@ -412,36 +1464,94 @@ class pgstmtworker():
     def _process_copyin(self, fecnn, raw_msg_list):
         self._write_msgs_to_fe(fecnn, raw_msg_list)
         try:
-            self._process_both(fecnn)
+            self._process_both(fecnn, (p.MsgType.MT_CopyDone, p.MsgType.MT_CopyFail))
         except fepgfatal as ex:
             if ex.last_fe_msg and ex.last_fe_msg.msg_type not in (p.MsgType.MT_CopyDone, p.MsgType.MT_CopyFail):
                 err_msg = str(ex.fatal_ex).encode('utf8')
                 self.becnn.write_msgs_until_done((p.CopyFail(err_msg=err_msg),))
             self._skip_be_msgs()
+        self._copyin_done()
     def _process_parse(self, fecnn, femsg):
+        fe_raw_msg_list = p.RawMsgChunk.Empty
+        if femsg._comment_info.cache and not femsg.stmt:
+            try:
+                fe_raw_msg_list = self._read_ext_msgs(fecnn)
+            except pgnet.pgfatal as ex: # ûз͸ˣ̴߳ǰӵĴ
+                self.fe_fatal = ex
+                return
+            cache_msg = self._make_ext_cache_msg(femsg, fe_raw_msg_list)
+            if cache_msg:
+                self.last_msg = cache_msg
+                self._process_query(fecnn, cache_msg)
+                return
         self.becnn.write_msgs_until_done((femsg,))
+        self.becnn.write_raw_msgs_until_done(fe_raw_msg_list)
         try:
-            self._process_both(fecnn)
+            self._process_both(fecnn, (p.MsgType.MT_Sync,), fe_raw_msg_list[-1] if fe_raw_msg_list else None)
         except fepgfatal as ex:
             # и⣬Parse/Bindʹֵ/portalôǲᱻclose
             if ex.last_fe_msg and ex.last_fe_msg.msg_type != p.MsgType.MT_Sync:
                 self.becnn.write_msgs_until_done((p.Sync(),))
             self._skip_be_msgs()
-    # ǰϢֱӺ˽յReadyForQuery
-    def _process_both(self, fecnn):
-        last_fe_msg = None
+        self._parse_done(femsg)
+    # ȡParseǰϢֱSyncFlush(ͻ˵ȴFlushĽ֮ŻᷢͺϢ)
+    def _read_ext_msgs(self, fecnn):
+        stop = (p.MsgType.MT_Sync, p.MsgType.MT_Flush)
+        raw_msg_list = p.RawMsgChunk.Empty
+        while not raw_msg_list or raw_msg_list[-1].msg_type not in stop:
+            raw_msg_list += fecnn.read_raw_msgs_until_avail(stop=stop).copy()
+        return raw_msg_list
+    # չѯЭĻ档ֻûֵParse+Bind+Describe+Execute+SyncǺ˷صϢ
+    # (ParseComplete/BindComplete/RowDescription/DataRow/CommandComplete/ReadyForQuery)еʱԭء
+    # cache keyQueryϢqueryParsesql + '\x00' + /ֵ/ʽȵmd5Querysqlܰ'\x00'
+    # Ժͼ򵥲ѯkeyͻ_ext_raw_msg_listǷ˵Ϣܻ򷵻None
+    def _make_ext_cache_msg(self, femsg, fe_raw_msg_list):
+        msg_types = tuple(m.msg_type for m in fe_raw_msg_list)
+        if msg_types != (p.MsgType.MT_Bind, p.MsgType.MT_Describe, p.MsgType.MT_Execute, p.MsgType.MT_Sync):
+            return None
+        bind, describe, execute, _ = (m.to_msg(fe=True) for m in fe_raw_msg_list)
+        if bind.portal or bind.stmt or describe.obj_name or execute.portal or execute.max_num:
+            return None
+        param_oids = b','.join(b'%d' % oid for oid in femsg.param_oids)
+        cache_msg = p.Query(query=bytes(femsg.query) + b'\x00' + p.md5(param_oids + bytes(fe_raw_msg_list[:3])))
+        cache_msg._comment_info = femsg._comment_info._replace(swr=None) # Queryˢ
+        cache_msg._ext_raw_msg_list = p.RawMsgChunk.join((femsg.to_rawmsg(),)) + fe_raw_msg_list
+        return cache_msg
+    def _write_query(self, msg):
+        ext_raw_msg_list = getattr(msg, '_ext_raw_msg_list', None)
+        if ext_raw_msg_list:
+            self.becnn.write_raw_msgs_until_done(ext_raw_msg_list)
+        else:
+            self.becnn.write_msgs_until_done((msg,))
+    # ûָcָt(cache_auto_tables޸ĵı)ʱصcache
+    def _parse_done(self, femsg):
+        if not femsg._comment_info.cache and femsg._comment_info.tables:
+            self.query_cache.clear(femsg._comment_info.tables, self.becnn.decode)
+    # COPY FROM STDINյReadyForQuery֮رcacheǰ˳ʱCOPYҲѾɹ(ѾCopyDone)Ҳա
+    def _copyin_done(self):
+        if self.last_msg._comment_info.tables:
+            self.query_cache.clear(self.last_msg._comment_info.tables, self.becnn.decode)
+    # ǰϢֱӺ˽յReadyForQuery
+    # ǰϢֻstopеϢΪֹ֮Ϣ(pipeline)ڽջ̴߳
+    # last_fe_msgǵ֮ǰѾ˵һǰϢ
+    def _process_both(self, fecnn, stop, last_fe_msg=None):
         while True:
-            netutils.poll2in(fecnn, self.becnn)
-            try:
-                raw_msg_list = fecnn.read_raw_msgs()
-                if raw_msg_list:
-                    last_fe_msg = raw_msg_list[-1]
-            except pgnet.pgfatal as ex:
-                raise fepgfatal(ex, last_fe_msg)
-            self.becnn.write_raw_msgs_until_done(raw_msg_list)
+            fe_done = last_fe_msg is not None and last_fe_msg.msg_type in stop
+            if not fe_done:
+                try:
+                    raw_msg_list = fecnn.read_raw_msgs(stop=stop)
+                    if raw_msg_list:
+                        last_fe_msg = raw_msg_list[-1]
+                except pgnet.pgfatal as ex:
+                    raise fepgfatal(ex, last_fe_msg)
+                self.becnn.write_raw_msgs_until_done(raw_msg_list)
             raw_msg_list = self.becnn.read_raw_msgs()
             if self._write_msgs_to_fe(fecnn, raw_msg_list)[1]:
                 break
+            if fe_done:
+                self.becnn.pollin()
+            else:
+                netutils.poll2in(fecnn, self.becnn)
     def _process_unsupported(self, fecnn, femsg):
         errmsg = p.ErrorResponse.make_error(b'unsupported msg type:%s' % femsg.msg_type)
         try:
@@ -461,20 +1571,28 @@ class pgstmtworker():
         if self.fe_fatal:
             return False, got_ready
         try:
-            fecnn.write_raw_msgs_until_done(raw_msg_list)
+            self._fe_write_raw_msgs(fecnn, raw_msg_list)
         except pgnet.pgfatal as ex:
             self.fe_fatal = ex
             return False, got_ready
         return True, got_ready
     def _write_cached_msgs_to_fe(self, fecnn, *raw_msg_lists):
         try:
+            # ȫŵͶУȻһͨsendmsg
             for raw_msg_list in raw_msg_lists:
-                fecnn.write_raw_msgs(raw_msg_list)
-            fecnn.write_raw_msgs_until_done()
+                fecnn.queue_raw_msgs(raw_msg_list)
+            self._fe_write_raw_msgs(fecnn)
         except pgnet.pgfatal as ex:
             self.fe_fatal = ex
             return False
         return True
+    # fe_spool_thresholdôͲfecnnķͶ(ֵĲдʱļ)У
+    # ̷߳ͣworkerõȴǰˣϴһϢ
+    def _fe_write_raw_msgs(self, fecnn, raw_msg_list=()):
+        if fecnn.spool_threshold > 0:
+            fecnn.write_raw_msgs(raw_msg_list)
+        else:
+            fecnn.write_raw_msgs_until_done(raw_msg_list)
     def _skip_be_msgs(self, raw_msg_list=()):
         if not raw_msg_list:
             raw_msg_list = self.becnn.read_raw_msgs_until_avail()
@@ -488,10 +1606,389 @@ class pgstmtworker():
         errstr = b'do not supoort transaction statement. abort it'
         add_raw_msg_list = p.RawMsgChunk.join((p.ErrorResponse.make_error(errstr).to_rawmsg(), p.ReadyForQuery.Idle.to_rawmsg()))
         return raw_msg_list[:-1] + add_raw_msg_list
+# worker_modeΪmuxʱʹõworkerauthȻڵ߳нУauthɹ֮󽻸pgmuxengine߳
+# Ƿģÿworkerһ״̬: Ϣ -> תϢ -> յReadyForQuery -> ǰݷꡣ
+# ״̬TrueʾǰϢϣFalseʾҪȴIO
+class pgmuxworker(pgstmtworker):
+    engine = None # ʱ
+    max_fe_send_sz = 1024*1024 # ǰ˷Ͷеݳֵʱͣȡ
+    max_be_send_sz = 1024*1024 # ˷Ͷеݳֵʱͣȡǰ
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state = None # ǰ״̬Noneʾ
+        self.fecnn = None
+        self.fe_fatal = None
+        self.flight = None # _st_wait_flightȴCacheFlight
+        self.be_writer = None # _st_queryбϢCacheWriter
+        self.copyin = False # ڴCOPY FROM STDINյReadyForQueryʱرcache
+        self.last_active = time.time()
+    def put(self, fecnn, msg):
+        super().put(fecnn, msg)
+        self.engine.notify(self)
+    def _after_auth(self):
+        self.engine.attach(self)
+    # ĺengine߳еá
+    # еϢֱҪȴIOexit_causeNoneʾworkerС
+    def _run(self):
+        while True:
+            if not self.state:
+                try:
+                    fecnn, self.last_msg, put_time = self.msg_queue.get_nowait()
+                except queue.Empty:
+                    return None
+                if fecnn is None:
+                    return 'normal'
+                self.fecnn, self.fe_fatal, self.need_skip = fecnn, None, False
+                self.times = (put_time, time.time())
+                if type(fecnn) is tuple:
+                    self._start_cmd(fecnn)
+                else:
+                    self._start_msg(fecnn, self.last_msg)
+            if not self.state():
+                return None
+    def _start_msg(self, fecnn, msg):
+        if msg.msg_type == p.MsgType.MT_Terminate:
+            print('<worker %d>: recved Terminate from %s' % (self.id, fecnn.peername()))
+            self.state = self._done
+            return
+        self.num_processed_msg += 1
+        if msg.msg_type == p.MsgType.MT_Query:
+            if msg._comment_info.cache and self._from_cache_or_wait(fecnn, msg):
+                return
+            self._start_query(msg, self._query_done, self._new_writer(msg))
+        elif msg.msg_type == p.MsgType.MT_Parse:
+            if msg._comment_info.cache and not msg.stmt:
+                self.fe_raw_msg_list = p.RawMsgChunk.Empty
+                self.state = self._st_ext_read
+                return
+            self.becnn.write_msgs((msg,))
+            self._start_both(copyin=False)
+        else:
+            errmsg = p.ErrorResponse.make_error(b'unsupported msg type:%s' % msg.msg_type)
+            try:
+                fecnn.write_msgs((errmsg, p.ReadyForQuery.Idle))
+            except pgnet.pgfatal as ex:
+                self.fe_fatal = ex
+            self.state = self._st_fe_flush
+    # ӻȡߵȴworkerִͬһѯ(single-flight)FalseʾҪɵǰworkerִвѯ
+    def _from_cache_or_wait(self, fecnn, msg):
+        if self._process_from_cache(fecnn, msg):
+            self.state = self._st_fe_flush
+            return True
+        flight = self._begin_flight(msg)
+        if flight is None:
+            return False
+        self.flight = flight
+        self.state = self._st_wait_flight
+        self.query_cache.flights.add_callback(flight, lambda: self.engine.notify(self))
+        return True
+    # leaderִ֮ӻȡleaderĽûб()ôԼִвѯ
+    def _st_wait_flight(self):
+        self._skip_idle_msgs()
+        if not self.flight.is_set():
+            return False
+        self.flight = None
+        if self._process_from_cache(self.fecnn, self.last_msg):
+            self.state = self._st_fe_flush
+        else:
+            self._start_query(self.last_msg, self._query_done, self._new_writer(self.last_msg))
+        return self.state()
+    # ȡParseǰϢֱSyncFlushԻôQueryһȫȻת_st_both
+    def _st_ext_read(self):
+        self._skip_idle_msgs()
+        stop = (p.MsgType.MT_Sync, p.MsgType.MT_Flush)
+        try:
+            raw_msg_list = self.fecnn.read_raw_msgs(stop=stop)
+        except pgnet.pgfatal as ex: # ûз͸
+            self.fe_fatal = ex
+            return self._done()
+        if raw_msg_list:
+            self.fe_raw_msg_list += raw_msg_list.copy()
+        if not self.fe_raw_msg_list or self.fe_raw_msg_list[-1].msg_type not in stop:
+            return False
+        femsg, fe_raw_msg_list = self.last_msg, self.fe_raw_msg_list
+        self.fe_raw_msg_list = None
+        cache_msg = self._make_ext_cache_msg(femsg, fe_raw_msg_list)
+        if cache_msg:
+            self.last_msg = cache_msg
+            if not self._from_cache_or_wait(self.fecnn, cache_msg):
+                self._start_query(cache_msg, self._query_done, self._new_writer(cache_msg))
+            return self.state()
+        self.becnn.write_msgs((femsg,))
+        self.becnn.write_raw_msgs(fe_raw_msg_list)
+        self._start_both(copyin=False)
+        self.last_fe_msg_type = fe_raw_msg_list[-1].msg_type
+        return self.state()
+    def _start_cmd(self, cmd):
+        name, *args = cmd
+        if name == 'pagecache':
+            msg, on_ready, writer = self._make_pagecache(args[0])
+        elif name == 'pagefetch':
+            msg, on_ready, writer = self._make_pagefetch(args[0])
+        else:
+            print('<worker %d>: unknown cmd: %s' % (self.id, name))
+            self.state = self._done
+            return
+        self._start_query(msg, on_ready, writer)
+    # on_readyյReadyForQueryʱãwriterwriterΪNoneʱеĺϢӵwriter
+    def _start_query(self, msg, on_ready, writer):
+        self.query_start = time.time()
+        ext_raw_msg_list = getattr(msg, '_ext_raw_msg_list', None)
+        if ext_raw_msg_list:
+            self.becnn.write_raw_msgs(ext_raw_msg_list)
+        else:
+            self.becnn.write_msgs((msg,))
+        self.on_ready, self.be_writer = on_ready, writer
+        self.first_be_msgs = True
+        self.state = self._st_query
+    def _start_both(self, copyin):
+        self.copyin = copyin
+        self.fe_stop = (p.MsgType.MT_CopyDone, p.MsgType.MT_CopyFail) if copyin else (p.MsgType.MT_Sync,)
+        self.last_fe_msg_type = None
+        self.state = self._st_both
+    def _st_query(self):
+        self._fe_write()
+        while not self._fe_busy():
+            raw_msg_list = self.becnn.read_raw_msgs()
+            if not raw_msg_list:
+                return False
+            if self.first_be_msgs:
+                self.first_be_msgs = False
+                msg_type = raw_msg_list[0].msg_type
+                if msg_type == p.MsgType.MT_CopyBothResponse:
+                    raise pgnet.pgfatal(None, 'do not support CopyBothResponse')
+                elif msg_type == p.MsgType.MT_CopyInResponse:
+                    self._fe_write(raw_msg_list)
+                    self._start_both(copyin=True)
+                    return self.state()
+                elif msg_type == p.MsgType.MT_CopyOutResponse:
+                    self._abort_writer()
+                    self.on_ready = None
+            if self.be_writer:
+                self.be_writer.append(raw_msg_list)
+            if self._forward_be_msgs(raw_msg_list):
+                if self.on_ready:
+                    self.on_ready(self.be_writer)
+                self._abort_writer()
+                return self._after_ready()
+        return False
+    # ǰϢֱӺ˽յReadyForQueryչѯЭCOPY FROM STDIN
+    def _st_both(self):
+        if self._fe_reading():
+            try:
+                raw_msg_list = self.fecnn.read_raw_msgs(stop=self.fe_stop)
+            except pgnet.pgfatal as ex:
+                self.fe_fatal, raw_msg_list = ex, None
+            if raw_msg_list:
+                self.last_fe_msg_type = raw_msg_list[-1].msg_type
+                self.becnn.write_raw_msgs(raw_msg_list)
+        self._fe_write()
+        while not self._fe_busy():
+            raw_msg_list = self.becnn.read_raw_msgs()
+            if not raw_msg_list:
+                break
+            if self._forward_be_msgs(raw_msg_list):
+                if self.copyin:
+                    self._end_copyin()
+                else:
+                    self._parse_done(self.last_msg)
+                return self._after_ready()
+        if not self.fe_fatal:
+            return False
+        # ǰ쳣ϿҪú˽ǰȻϢֱReadyForQuery
+        # и⣬Parse/Bindʹֵ/portalôǲᱻclose
+        if self.copyin:
+            if self.last_fe_msg_type not in (p.MsgType.MT_CopyDone, p.MsgType.MT_CopyFail):
+                self.becnn.write_msgs((p.CopyFail(err_msg=str(self.fe_fatal).encode('utf8')),))
+        elif self.last_fe_msg_type != p.MsgType.MT_Sync:
+            self.becnn.write_msgs((p.Sync(),))
+        self.state = self._st_skip
+        return self.state()
+    # ϢֱReadyForQuery
+    def _st_skip(self):
+        while True:
+            raw_msg_list = self.becnn.read_raw_msgs()
+            if not raw_msg_list:
+                return False
+            if raw_msg_list[-1].msg_type == p.MsgType.MT_ReadyForQuery:
+                self._end_copyin()
+                self.state = self._st_fe_flush
+                return self.state()
+    # ȴǰ˵ݷꡣfe_spool_thresholdôʣµ̷߳͡
+    def _st_fe_flush(self):
+        self._fe_write()
+        if self._has_fe() and self.fecnn.send_sz and self.fecnn.spool_threshold <= 0:
+            return False
+        return self._done()
+    def _done(self):
+        self._end_flight()
+        put_time, get_time = self.times
+        done_time = time.time()
+        self.engine.forget(self.fecnn) # ߳¼fecnn֮ǰ
+        self.main_queue.put(('done', self.fecnn, self, (put_time, get_time-put_time, done_time-get_time)))
+        self.state = self.fecnn = None
+        self.last_active = done_time
+        return True
+    def _end_copyin(self):
+        if self.copyin:
+            self.copyin = False
+            self._copyin_done()
+    def _after_ready(self):
+        self.state = self._st_skip if self.need_skip else self._st_fe_flush
+        return self.state()
+    def _abort_writer(self):
+        if self.be_writer:
+            self.be_writer.abort()
+            self.be_writer = None
+    # ѺϢдǰˣǷյReadyForQuery״̬idleôabort֮ҪabortĽ
+    def _forward_be_msgs(self, raw_msg_list):
+        if raw_msg_list[-1].msg_type != p.MsgType.MT_ReadyForQuery:
+            self._fe_write(raw_msg_list)
+            return False
+        m = raw_msg_list[-1].to_msg(fe=False)
+        if m.trans_status != p.TransStatus.TS_Idle:
+            self.becnn.write_msgs((p.Query(query=b'abort'),))
+            self.need_skip = True
+            raw_msg_list = self._change_msgs_to_idle(raw_msg_list)
+        self._fe_write(raw_msg_list)
+        return True
+    # еʱֻᷢ첽ϢֱӶ˶Ͽ׳pgfatal
+    def _skip_idle_msgs(self):
+        self.becnn.read_raw_msgs()
+    def _has_fe(self):
+        return self.fecnn is not None and type(self.fecnn) is not tuple and not self.fe_fatal
+    def _fe_busy(self):
+        return self._has_fe() and self.fecnn.send_sz > self.max_fe_send_sz and self.fecnn.spool_threshold <= 0
+    # ǷҪǰϢfe_stopеϢ֮ǰϢ(pipeline)̴߳
+    # ˷Ͷгmax_be_send_szʱͣȡȴ͸ˡ
+    def _fe_reading(self):
+        if self.state == self._st_ext_read:
+            return self._has_fe()
+        return self._has_fe() and self.state == self._st_both and self.last_fe_msg_type not in self.fe_stop and self.becnn.send_sz <= self.max_be_send_sz
+    def _fe_write(self, raw_msg_list=()):
+        if not self._has_fe():
+            return
+        try:
+            self.fecnn.write_raw_msgs(raw_msg_list)
+        except pgnet.pgfatal as ex:
+            self.fe_fatal = ex
+    # cacheеϢֻŵͶУ_st_fe_flush͡
+    def _write_cached_msgs_to_fe(self, fecnn, *raw_msg_lists):
+        for raw_msg_list in raw_msg_lists:
+            fecnn.queue_raw_msgs(raw_msg_list)
+        self._fe_write()
+        return not self.fe_fatal
+# һ߳еpgmuxworker
+# ߳ͨnotify֪ͨworkerϢengineworker״̬ǰӵĶд¼
+class pgmuxengine():
+    def __init__(self):
+        self.queue = mainqueue() # ͨwakerpollеengine߳
+        self.poll = netutils.epoller()
+        self.poll.register(self.queue.waker, self.poll.POLLIN)
+        self.workers = set()
+        self.cnn2worker = {}
+    def attach(self, w):
+        self.queue.put(('attach', w))
+    def notify(self, w):
+        self.queue.put(('msg', w))
+    def run(self):
+        timeout = None
+        while True:
+            for fobj, event in self.poll.poll(timeout):
+                if fobj is self.queue.waker:
+                    fobj.clear()
+                    continue
+                w = self.cnn2worker.get(fobj)
+                if w:
+                    self._run_worker(w, fobj)
+            self._process_queue()
+            timeout = self._check_idle()
+    def _process_queue(self):
+        while True:
+            try:
+                cmd, w = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if cmd == 'attach':
+                self.workers.add(w)
+                self.cnn2worker[w.becnn] = w
+                w.last_active = time.time()
+            if w in self.workers:
+                self._run_worker(w)
+    def _run_worker(self, w, fobj=None):
+        try:
+            # Ƿģwrite_msgsֻһ֣ʣµ
+            if w.becnn.send_sz:
+                w.becnn.write_msgs()
+            if fobj is w.becnn and not w.state:
+                w._skip_idle_msgs()
+            exit_cause = w._run()
+        except pgnet.pgfatal as ex:
+            print('<worker %d>: BE%s: %s' % (w.id, w.becnn.peername(), ex))
+            w._end_flight()
+            w._abort_writer()
+            w._page_failed()
+            if w.fecnn is not None and type(w.fecnn) is not tuple:
+                self.forget(w.fecnn)
+                w.fecnn.close()
+            exit_cause = 'befatal'
+        if exit_cause:
+            self._detach(w, exit_cause)
+        else:
+            self._update(w)
+    def _detach(self, w, exit_cause):
+        self.workers.discard(w)
+        self.forget(w.becnn)
+        w.becnn.close()
+        w.main_queue.put(('exit', exit_cause, w))
+    # worker״̬Ҫ¼
+    def _update(self, w):
+        ev = 0 if w._fe_busy() else self.poll.POLLIN
+        if w.becnn.send_sz:
+            ev |= self.poll.POLLOUT
+        self._register(w, w.becnn, ev)
+        if not w._has_fe():
+            return
+        ev = self.poll.POLLIN if w._fe_reading() else 0
+        if w.fecnn.send_sz:
+            ev |= self.poll.POLLOUT
+        if ev:
+            self._register(w, w.fecnn, ev)
+        else:
+            self.forget(w.fecnn)
+    def _register(self, w, cnn, ev):
+        x = self.poll.fd2objs.get(cnn.fileno())
+        if x and x[0] is cnn and x[1] == ev:
+            return
+        self.poll.register(cnn, ev)
+        self.cnn2worker[cnn] = w
+    def forget(self, cnn):
+        if self.cnn2worker.pop(cnn, None):
+            self.poll.clear((cnn,))
+    # رտгʱworker´pollĳʱʱ䡣
+    def _check_idle(self):
+        now = time.time()
+        timeout = None
+        for w in list(self.workers):
+            if w.state or not w.msg_queue.empty():
+                continue
+            t = w.last_active + w.idle_timeout - now
+            if t <= 0:
+                self._detach(w, 'idle')
+            elif timeout is None or t < timeout:
+                timeout = t
+        return timeout
+    @classmethod
+    def start(cls):
+        e = cls()
+        thr = threading.Thread(target=e.run)
+        thr.start()
+        return e
 # ¼ĳbe_addrpgworkerstartup_msg顣
 # pgworkerм¼poolid
 @mputils.generateid
 class pgstmtworkerpool():
+    worker_class = pgstmtworker # worker_modeΪmuxʱpgmuxworker
     def __init__(self, be_addr):
         self.be_addr = be_addr
         self.workers_map = collections.defaultdict(list) # startup_msg -> worker_list
@@ -512,12 +2009,12 @@ class pgstmtworkerpool():
     # һµworkerʱworkerûӵpool棬
     # ̴߳main_queueյauthɹ֮Żworkerӵpool
     def new_worker(self, fecnn, main_queue,):
-        w = pgstmtworker(self.id, self.be_addr, main_queue)
+        w = self.worker_class(self.id, self.be_addr, main_queue)
         thr = threading.Thread(target=w.run, args=(fecnn,))
         thr.start()
         return w
     def new_worker2(self, kwargs, main_queue):
-        w = pgstmtworker(self.id, self.be_addr, main_queue)
+        w = self.worker_class(self.id, self.be_addr, main_queue)
         thr = threading.Thread(target=w.run2, args=(kwargs,))
         thr.start()
         return w
@@ -566,8 +2063,8 @@ class pgstmtworkerpool():
         return len(self.id2worker_map)
     def __bool__(self):
         return True
-    # ǰcnnϢmsgַӦworker
-    def dispatch_fe_msg(self, poll, cnn, msg):
+    # ǰcnnϢбmsg_listַͬһworkerworker˳Ӧ˳Ϣ˳һ¡
+    def dispatch_fe_msgs(self, poll, cnn, msg_list):
         if not cnn:
             return
         worker_list = self.workers_map[cnn.startup_msg]
@@ -575,7 +2072,8 @@ class pgstmtworkerpool():
             cnn.close()
         else:
             nextidx = self.nextidx_map[cnn.startup_msg] % len(worker_list)
-            worker_list[nextidx].put(cnn, msg)
+            for msg in msg_list:
+                worker_list[nextidx].put(cnn, msg)
             self.nextidx_map[cnn.startup_msg] = (nextidx + 1) % len(worker_list)
     def dispatch_cmd_msg(self, startup_msg, cmd):
         worker_list = self.workers_map[startup_msg]
@@ -585,6 +2083,7 @@ class pgstmtworkerpool():
             self.nextidx_map[startup_msg] = (nextidx + 1) % len(worker_list)
     # worker쳣˳ʱҪʣµϢַworkerϡڵ֮ǰremove worker
     def dispatch_worker_remain_msg(self, poll, w):
+        fe_msgs = {} # ͬһǰӵϢַͬһworker
         while True:
             try:
                 cnn, msg, put_time = w.msg_queue.get_nowait()
@@ -593,7 +2092,9 @@ class pgstmtworkerpool():
             if type(cnn) is tuple:
                 self.dispatch_cmd_msg(w.startup_msg, cnn)
             else:
-                self.dispatch_fe_msg(poll, cnn, msg)
+                fe_msgs.setdefault(cnn, []).append(msg)
+        for cnn, msg_list in fe_msgs.items():
+            self.dispatch_fe_msgs(poll, cnn, msg_list)
 # һpoolɵб
 class pgstmtworkerpools():
     def __init__(self, *be_addr_list):
@@ -712,8 +2213,8 @@ class pgstmtworkerpools():
             return
         pool_list = self.pools_map[w.startup_msg]
         pool_list.remove(pool)
-    # ǰcnnϢmsgַӦworker
-    def dispatch_fe_msg(self, poll, cnn, msg):
+    # ǰcnnϢбmsg_listַӦworker
+    def dispatch_fe_msgs(self, poll, cnn, msg_list):
         if not cnn:
             return
         pool_list = self.pools_map[cnn.startup_msg]
@@ -721,7 +2222,7 @@ class pgstmtworkerpools():
             cnn.close()
         else:
             nextidx = self.nextidx_map[cnn.startup_msg] % len(pool_list)
-            pool_list[nextidx].dispatch_fe_msg(poll, cnn, msg)
+            pool_list[nextidx].dispatch_fe_msgs(poll, cnn, msg_list)
             self.nextidx_map[cnn.startup_msg] = (nextidx + 1) % len(pool_list)
     def dispatch_cmd_msg(self, startup_msg, cmd):
         pool_list = self.pools_map[startup_msg]
@@ -731,6 +2232,7 @@ class pgstmtworkerpools():
             self.nextidx_map[startup_msg] = (nextidx + 1) % len(pool_list)
     # worker쳣˳ʱҪʣµϢַworkerϡڵ֮ǰremove worker
     def dispatch_worker_remain_msg(self, poll, w):
+        fe_msgs = {} # ͬһǰӵϢַͬһworker
         while True:
             try:
                 cnn, msg, put_time = w.msg_queue.get_nowait()
@@ -739,7 +2241,9 @@ class pgstmtworkerpools():
             if type(cnn) is tuple:
                 self.dispatch_cmd_msg(w.startup_msg, cnn)
             else:
-                self.dispatch_fe_msg(poll, cnn, msg)
+                fe_msgs.setdefault(cnn, []).append(msg)
+        for cnn, msg_list in fe_msgs.items():
+            self.dispatch_fe_msgs(poll, cnn, msg_list)
 # ¼authɹfeӣstartup_msg顣
 # 2authɹ: new_workerɹʱpgauthɹʱ
 class feconnpool():
@@ -805,6 +2309,8 @@ class pooldb(pseudodb.pseudodb):
         if host == '0.0.0.0':
             host = self.getpeername()[0]
         self.g_conf['spool'].append((host, int(port)))
+        if self.g_conf['global']['ctl_ep']: # ģʽ̸֪ͨӳ
+            send_ctl_msg(b'r', '%s:%s' % (host, port))
         return self._write_result(['register'], [('ok',)])
     # spool
     @mputils.mycmd('spool', cmd_map)
@@ -820,19 +2326,13 @@ class pooldb(pseudodb.pseudodb):
         if not args:
             return self._write_error('change_master need args host:port')
         host, port = args[0].split(':')
-        new_master_addr = (host, int(port))
-        pool_list = self.slaver_pools.get_byaddr(new_master_addr)
-        if not pool_list:
-            self._write_error('no pool for %s' % (new_master_addr,))
-        
-        self.slaver_pools.remove(pool_list[0], clear=False)
-        self.slaver_pools.remove_byaddr(self.master_pool.be_addr, clear=True)
-        miscutils.remove_all(self.g_conf['slaver'], self.master_pool.be_addr)
-        self.master_pool.clear()
-        globals()['master_pool'] = pool_list[0]
-        self.g_conf['global']['master_pool'] = self.master_pool = globals()['master_pool']
-        self.g_conf['master'] = self.master_pool.be_addr
-        self.g_conf['slaver'].remove(self.master_pool.be_addr)
+        if self.g_conf['global']['ctl_ep']: # ģʽ֪ͨӽл
+            send_ctl_msg(b'm', '%s:%s' % (host, port))
+            return self._write_result(['change_master'], [('ok',)])
+        errmsg = change_master((host, int(port)))
+        if errmsg:
+            return self._write_error(errmsg)
+        self.master_pool = self.g_conf['global']['master_pool']
         return self._write_result(['change_master'], [('ok',)])
     # cmd
     @mputils.mycmd('cmd', cmd_map)
@@ -847,11 +2347,16 @@ class pooldb(pseudodb.pseudodb):
     @mputils.mycmd('shutdown', cmd_map)
     def cmd(self, args, sub_cmd_map):
         print('shutdown...')
+        if self.g_conf['global']['ctl_ep']: # ģʽ̽ӽ
+            send_ctl_msg(b's', '')
         # sys.exit(1) will waiting threads to exit
         os._exit(1)
-    # cache
+    # cache [list|expire|stats|top|warm]
     @mputils.mycmd('cache', cmd_map)
     def cmd(self, args, sub_cmd_map):
+        return self._common_with_sub_cmd(args, sub_cmd_map)
+    @cmd.sub_cmd(name='list')
+    def cmd(self, args):
         rows = []
         for m, qc in self.query_cache_map.items():
             startup_msg = self._make_startup_msg(m)
@@ -859,6 +2364,58 @@ class pooldb(pseudodb.pseudodb):
                 timeout = datetime.datetime.fromtimestamp(citem.timeout).time()
                 rows.append((m['database'], m['user'], startup_msg, sql, timeout, citem.tables, citem.msg_count(), citem.size, citem.in_file()))
         return self._write_result(['database', 'user', 'startup_msg', 'sql', 'timeout', 'tables', 'msg_cnt', 'size', 'in_file'], rows)
+    @cmd.sub_cmd(name='expire')
+    def cmd(self, args):
+        with QueryCache.lock:
+            row = (QueryCache.expired_cnt, QueryCache.expired_bytes, len(QueryCache.expire_heap), QueryCache.lru.mem_bytes, QueryCache.lru.disk_bytes)
+        return self._write_result(['expired_cnt', 'expired_bytes', 'pending', 'mem_bytes', 'disk_bytes'], [row])
+    # savedǽʡĺʱ()д*ƽbuildʱơ
+    @cmd.sub_cmd(name='stats')
+    def cmd(self, args):
+        rows = []
+        for m, qc in self.query_cache_map.items():
+            startup_msg = self._make_startup_msg(m)
+            st = qc.stats
+            lookups = st.hits + st.misses
+            hit_ratio = '%.3f' % (st.hits / lookups) if lookups else 'None'
+            avg_build = st.build_time / st.builds if st.builds else 0
+            z_ratio = '%.3f' % (st.compress_out / st.compress_in) if st.compress_in else 'None'
+            rows.append((m['database'], m['user'], startup_msg, len(qc), st.hits, st.stale_hits, st.misses, st.expired_misses, hit_ratio, 
+                         st.mem_bytes_served, st.file_bytes_served, st.builds, '%.3f' % (avg_build*1000), '%.3f' % (st.hits*avg_build), st.evicted, st.rejected, 
+                         z_ratio, '%.3f' % (st.compress_time*1000), '%.3f' % (st.decompress_time*1000)))
+        return self._write_result(['database', 'user', 'startup_msg', 'items', 'hits', 'stale_hits', 'misses', 'expired_misses', 'hit_ratio', 
+                                   'mem_bytes_served', 'file_bytes_served', 'builds', 'avg_build_ms', 'saved', 'evicted', 'rejected', 
+                                   'compress_ratio', 'compress_ms', 'decompress_ms'], rows)
+    # cache top [n] [saved|hits|bytes] : ʡĺʱ(ȱʡ)/д/͵гǰn(ȱʡ20)itemcache_backend=shmʱûitemͳơ
+    @cmd.sub_cmd(name='top')
+    def cmd(self, args):
+        args = args[0].split() if args else []
+        n = int(args[0]) if args else 20
+        key = args[1] if len(args) > 1 else 'saved'
+        keyfuncs = {'saved': lambda c: c.hits * c.build_time, 'hits': lambda c: c.hits, 'bytes': lambda c: c.bytes_served}
+        if key not in keyfuncs:
+            return self._write_error('cache top should be sorted by saved, hits or bytes')
+        items = []
+        for m, qc in self.query_cache_map.items():
+            items.extend((m, sql, citem) for sql, citem in qc.get_all())
+        items.sort(key=lambda x: keyfuncs[key](x[2]), reverse=True)
+        rows = []
+        for m, sql, citem in items[:n]:
+            rows.append((m['database'], m['user'], sql, citem.hits, citem.bytes_served, '%.3f' % (citem.build_time*1000), 
+                         '%.3f' % (citem.hits*citem.build_time), citem.size, citem.in_file()))
+        return self._write_result(['database', 'user', 'sql', 'hits', 'bytes_served', 'build_ms', 'saved', 'size', 'in_file'], rows)
+    # ԤȵĽȡelapsedѾ˶룬ԤɵʱfinishedΪTrue
+    @cmd.sub_cmd(name='warm')
+    def cmd(self, args):
+        warmer = self.g_conf['global']['cache_warmer']
+        if not warmer:
+            return self._write_error('cache_warm_file is not set')
+        running = collections.Counter(m for m, _, _ in warmer.running.values())
+        rows = []
+        for m, (total, done, start_time, end_time) in warmer.progress.items():
+            elapsed = (end_time or time.time()) - start_time
+            rows.append((m['database'], m['user'], self._make_startup_msg(m), total, done, running[m], total - done - running[m], '%.3f' % elapsed, end_time is not None))
+        return self._write_result(['database', 'user', 'startup_msg', 'total', 'done', 'running', 'pending', 'elapsed', 'finished'], rows)
     # ͨ
     def _common_with_sub_cmd(self, args, sub_cmd_map, default_sub_cmd='list'):
         if not args:
@@ -989,17 +2546,25 @@ class pooldb(pseudodb.pseudodb):
 #   .) CancelRequest
 #   .) ͱʼ
 class pgmiscworker():
+    expire_interval = 1 # ÿɾʱĲѯ
     def __init__(self):
         self.work_queue = queue.Queue()
     def put(self, name, args):
         self.work_queue.put_nowait((name, args))
     def run(self):
+        next_expire_time = time.time() + self.expire_interval
         while True:
-            name, args = self.work_queue.get()
+            try:
+                name, args = self.work_queue.get(timeout=max(next_expire_time - time.time(), 0))
+            except queue.Empty:
+                name, args = 'ExpireCache', None
             if name is None:
                 return
             if name == 'CancelRequest':
                 self._process_CancelRequest(args)
+            elif name == 'ExpireCache':
+                self._process_ExpireCache(args)
+                next_expire_time = time.time() + self.expire_interval
             else:
                 print('<miscworker> unknown work name:%s args:%s' % (name, args))
     def _process_CancelRequest(self, args):
@@ -1012,12 +2577,318 @@ class pgmiscworker():
                 continue
             cnn.write_msgs_until_done((msg,))
             cnn.close()
+    # ɾʱĲѯ棬ÿ֮ͷworkerԷʻ档
+    def _process_ExpireCache(self, args):
+        while QueryCache.expire() >= QueryCache.expire_batch:
+            pass
     @classmethod
     def start(cls):
         w = cls()
         thr = threading.Thread(target=w.run)
         thr.start()
         return w
+# ʧЧ߳(cache_notify_channel)ӵⲢLISTEN channelݿеĴNOTIFY channel, 't1,t2'֪ͨЩ
+# ޸(öŻ߿ոָ)յ֪ͨٵȴbatch_interval룬ʱյıȥ֮ͨmain_queuẹ߳
+# ߳QueryCacheЩصcacheӶϿڼ֪ͨᶪʧÿLISTENɹ֮кͱصcache
+# ʧܺÿretry_intervalӵǰ⡣HA/change_master֮߳reconnect߳ÿcheck_interval
+# һΣreconnectg_conf['master']˾ӵ(ܻڣӲϿ)TCP keepalive
+# 崻Ͽɵİ뿪keepaliveʱ֮ȡȻӡ
+class pgcachelistener():
+    batch_interval = 0.1
+    retry_interval = 3
+    check_interval = 1
+    keepalive = (30, 10, 3) # TCP_KEEPIDLE/TCP_KEEPINTVL/TCP_KEEPCNT
+    def __init__(self, main_queue, channel, cnn_param):
+        self.main_queue = main_queue
+        self.channel = channel
+        self.cnn_param = cnn_param
+        self.reconnect = False
+    def run(self):
+        while True:
+            cnn = None
+            try:
+                self.reconnect = False
+                addr = tuple(g_conf['master'])
+                cnn = pgnet.pgconn(host=addr[0], port=addr[1], **self.cnn_param)
+                self._set_keepalive(cnn.s)
+                cnn.query('LISTEN "%s"' % self.channel.replace('"', '""'))
+                print('<cachelistener> listen on %s at %s:%s' % (self.channel, addr[0], addr[1]))
+                self.main_queue.put(('cacheclear', None))
+                self._listen(cnn, addr)
+                print('<cachelistener> master changed, reconnect to %s:%s' % tuple(g_conf['master']))
+                continue
+            except Exception as ex:
+                print('<cachelistener> ERROR: %s' % (ex,))
+            finally:
+                if cnn: cnn.close()
+            time.sleep(self.retry_interval)
+    def _set_keepalive(self, s):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            idle, intvl, cnt = self.keepalive
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, intvl)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, cnt)
+    # Ҫӵʱ򷵻أӳʱ׳쳣
+    def _listen(self, cnn, addr):
+        tables = set()
+        batch_end = None
+        while not self.reconnect and tuple(g_conf['master']) == addr:
+            timeout = self.check_interval if batch_end is None else max(batch_end - time.time(), 0)
+            cnn.read_async_msgs(timeout)
+            for pid, channel, payload in cnn.notification_am():
+                tables.update(t for t in re.split(r'[\s,]+', payload) if t)
+            cnn.clear_async_msgs()
+            if tables and batch_end is None:
+                batch_end = time.time() + self.batch_interval
+            if batch_end is not None and time.time() >= batch_end:
+                self.main_queue.put(('cacheclear', tuple(tables)))
+                tables = set()
+                batch_end = None
+    @classmethod
+    def start(cls, *args):
+        w = cls(*args)
+        thr = threading.Thread(target=w.run)
+        thr.start()
+        return w
+# Ԥ(cache_warm_file)ֻ߳ʹácache_warm_filepythonļеqueries(database, user, sql)б
+# sqlעָcĳstartup_msgĵһworkerɹʱ(֮)ԼHA֮ϵÿstartup_msg
+# database/userƥĲѯΪpagecacheͨdispatch_cmd_msgworkerִвŵУͬʱִеconcurrency
+# workerִ(done)֮ٷַһworker쳣˳ʱִеᶪʧtimeoutѾִꡣ
+class pgcachewarmer():
+    def __init__(self, queries, concurrency=2, timeout=300):
+        self.queries = queries
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.progress = {} # startup_msg -> [total, done, start_time, end_time]
+        self.pending = collections.deque() # (startup_msg, cmd)
+        self.running = {} # id(cmd) -> (startup_msg, cmd, dispatch_time)
+    @classmethod
+    def from_file(cls, fn, concurrency, timeout):
+        return cls(miscutils.read_conf_file(fn, 'queries'), concurrency, timeout)
+    # rewarmΪTrueʱʹѾԤȹҲԤ(HA֮)
+    def warm(self, pool, startup_msg, rewarm=False):
+        if startup_msg in self.progress and not rewarm:
+            return
+        total = 0
+        for database, user, sql in self.queries:
+            if startup_msg['database'] != database.encode('utf8') or startup_msg['user'] != user.encode('utf8'):
+                continue
+            try:
+                msg = parse_query_comment(p.Query(query=sql.encode('utf8')))
+            except Exception as ex:
+                print('<cachewarmer> invalid sql(%s): %s' % (sql, ex))
+                continue
+            if not msg._comment_info.cache:
+                print('<cachewarmer> sql should contain c in comment: %s' % (sql,))
+                continue
+            self.pending.append((startup_msg, ('pagecache', msg)))
+            total += 1
+        if total:
+            print('<cachewarmer> warm %d queries for %s' % (total, startup_msg))
+        self.progress[startup_msg] = [total, 0, time.time(), None if total else time.time()]
+        self.dispatch(pool)
+    # л֮ãԭworkerִеѾʧ
+    def rewarm_all(self, pool):
+        self.pending.clear()
+        self.running.clear()
+        for startup_msg, worker_list in list(pool.workers_map.items()):
+            if worker_list:
+                self.warm(pool, startup_msg, True)
+    # ߳յdoneʱãcmdworkerִ
+    def done(self, pool, cmd):
+        x = self.running.pop(id(cmd), None)
+        if x:
+            self._finish(x[0])
+        self.dispatch(pool)
+    def _finish(self, startup_msg):
+        x = self.progress[startup_msg]
+        x[1] += 1
+        if x[1] >= x[0]:
+            x[3] = time.time()
+    def dispatch(self, pool):
+        now = time.time()
+        for k, (startup_msg, cmd, t) in list(self.running.items()):
+            if now - t > self.timeout:
+                del self.running[k]
+                self._finish(startup_msg)
+        while self.pending and len(self.running) < self.concurrency:
+            startup_msg, cmd = self.pending.popleft()
+            if not pool.has_worker(startup_msg): # workerѾ˳
+                self._finish(startup_msg)
+                continue
+            self.running[id(cmd)] = (startup_msg, cmd, now)
+            pool.dispatch_cmd_msg(startup_msg, cmd)
+# ̵߳ϢСworker/pgmonitorputϢʱͨwakerpollе̣߳
+# ߳̿еʱһֱҪʱpoll
+class mainqueue(queue.Queue):
+    def __init__(self):
+        super().__init__()
+        self.waker = netutils.waker()
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.waker.wakeup()
+# ģʽ(procs>1)µ̡forkprocsӽ̣ӽ쳣˳̻fork
+# ̸HA(pgmonitor/process_ha)Ȼл֪ͨӽ̡ǰӵķַʽdispatchȷ:
+#   .) reuseport   : ӽͨSO_REUSEPORTͬһ˿ڣ̲ǰӡ
+#   .) startup_msg : ̼˿ڲȡstartup_msgȻǰӴstartup_msgӦӽ̣
+#                    ͬһstartup_msgǰӶͬһӽ̴ӽеworker
+#                    authӽ̸ΪһǰҪworkerת˽auth
+# ̺ӽ֮ͨsocketpair(uds_ep)ͨţϢݳb'f'֮ⶼstr:
+#   .) b'r' : ӽ->̡ӳעᣬϢΪhost:port
+#   .) b'm' : ˫лϢΪhost:port
+#   .) b's' : ӽ->̡shutdown̽ӽ̺˳
+#   .) b'f' : ->ӽ̡ǰӣϢΪstartup_msgǰӵ
+# ӽ̼⵽̵ӶϿҲ˳
+class pgsupervisor():
+    def __init__(self, procs, dispatch='reuseport'):
+        if dispatch not in ('reuseport', 'startup_msg'):
+            raise RuntimeError('procs_dispatch should be reuseport or startup_msg')
+        self.procs = procs
+        self.dispatch = dispatch
+        self.ep_list = [None] * procs # idxӽ̵uds_epforkӽʹͬidx
+        self.poll = netutils.epoller()
+        self.main_queue = None
+        self.listen = None
+        self.next_idx = 0 # CancelRequestַӽ
+    # ֻӽвŻ᷵أֵǺͨŵuds_ep
+    def run(self):
+        global master_pool, slaver_pools, mon_worker
+        for idx in range(self.procs):
+            ep = self._fork(idx)
+            if ep:
+                return ep
+        g_conf['global']['master_pool'] = master_pool = pgstmtworkerpool(g_conf['master'])
+        g_conf['global']['slaver_pools'] = slaver_pools = pgstmtworkerpools(*g_conf.get('slaver',()))
+        self.main_queue = mainqueue()
+        self.poll.register(self.main_queue.waker, self.poll.POLLIN)
+        if g_conf.get('enable_ha', False):
+            mon_worker = pgmonitor(self.main_queue, g_conf.get('ha_after_fail_cnt', 10), g_conf.get('ha_check_interval', 3))
+            mon_worker.start(host=g_conf['master'][0], port=g_conf['master'][1], **g_conf['admin_cnn'])
+        if self.dispatch == 'startup_msg':
+            self.listen = netutils.listener(g_conf['listen'], async=True)
+            self.poll.register(self.listen, self.poll.POLLIN)
+        host, port = g_conf['listen']
+        register_to_mpool((host or '0.0.0.0', port))
+        while True:
+            for fobj, event in self.poll.poll():
+                if fobj is self.main_queue.waker:
+                    fobj.clear()
+                    self._process_main_queue()
+                    continue
+                if fobj is self.listen:
+                    cs, addr = fobj.accept()
+                    print('<supervisor> accept connection from %s' % (addr,))
+                    self.poll.register(pgnet.feconn4startup(pgnet.feconn(cs)), self.poll.POLLIN)
+                    continue
+                if type(fobj) is pgnet.feconn4startup:
+                    self._process_fe(fobj)
+                    continue
+                try:
+                    msg_list = fobj.recv_msgs()
+                except (RuntimeError, OSError) as ex:
+                    ep = self._respawn(fobj)
+                    if ep:
+                        return ep
+                    continue
+                for msg_type, msg_data, _ in msg_list:
+                    self._process_msg(msg_type, msg_data.decode('utf8'))
+    def _fork(self, idx):
+        s1, s2 = socket.socketpair()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            s1.close()
+            # pollעĶ̵(uds_ep/waker/listen/ûȡstartup_msgǰ)ӽҪص
+            # ܵself.poll.close()ΪӺ̹epollɾעfd
+            for fobj, _ in list(self.poll.fd2objs.values()):
+                fobj.close()
+            if hasattr(self.poll, 'p'):
+                self.poll.p.close()
+            ep = netutils.uds_ep(s2)
+            ep.idx = idx
+            return ep
+        s2.close()
+        ep = netutils.uds_ep(s1)
+        ep.pid, ep.start_time = pid, time.time()
+        self.ep_list[idx] = ep
+        self.poll.register(ep, self.poll.POLLIN)
+        print('<supervisor> fork process %d' % pid)
+        return None
+    def _respawn(self, ep):
+        self.poll.unregister(ep)
+        ep.close()
+        os.waitpid(ep.pid, 0)
+        print('<supervisor> process %d exited' % ep.pid)
+        if time.time() - ep.start_time < 1: # ӽ˳²ͣfork
+            time.sleep(1)
+        return self._fork(self.ep_list.index(ep))
+    # ȡstartup_msgȻǰӴӽ̡SSLRequest̴
+    def _process_fe(self, fobj):
+        try:
+            m = fobj.read_startup_msg()
+            if not m:
+                return
+            if m.code == p.PG_SSLREQUEST_CODE:
+                fobj.write_no_ssl()
+                return
+        except pgnet.pgfatal as ex:
+            print('<supervisor> %s: %s' % (ex.__class__.__name__, ex))
+            self.poll.unregister(fobj)
+            fobj.close()
+            return
+        self.poll.unregister(fobj)
+        if m.code == p.PG_PROTO_VERSION3_NUM:
+            idx = hash(m) % self.procs
+        else:
+            idx = self.next_idx = (self.next_idx + 1) % self.procs
+        ep = self.ep_list[idx]
+        ep.put_msg(b'f', bytes(m), [fobj.fileno()])
+        try:
+            ep.send_all()
+        except OSError as ex:
+            print('<supervisor> send to process %d fail: %s' % (ep.pid, ex))
+        fobj.close()
+    def _process_msg(self, msg_type, msg_data):
+        print('<supervisor> %s %s' % (msg_type, msg_data))
+        if msg_type == b'r':
+            host, port = msg_data.split(':')
+            g_conf['spool'].append((host, int(port)))
+        elif msg_type == b'm':
+            host, port = msg_data.split(':')
+            errmsg = change_master((host, int(port)))
+            if errmsg:
+                print('<supervisor> change_master fail: %s' % errmsg)
+            self._broadcast(b'm', msg_data)
+        elif msg_type == b's':
+            for ep in self.ep_list:
+                os.kill(ep.pid, signal.SIGTERM)
+            os._exit(1)
+        else:
+            raise RuntimeError('unknown msg from child process:%s' % ((msg_type, msg_data),))
+    def _process_main_queue(self):
+        need_ha = False
+        while True:
+            try:
+                x = self.main_queue.get_nowait()
+            except queue.Empty:
+                break
+            print(x)
+            if x[0] == 'pgdown': # ('pgdown', host, port)
+                need_ha = True
+        if not need_ha:
+            return
+        old_master_addr = master_pool.be_addr
+        process_ha()
+        if master_pool.be_addr != old_master_addr:
+            self._broadcast(b'm', '%s:%s' % master_pool.be_addr)
+    def _broadcast(self, msg_type, msg_data):
+        for ep in self.ep_list:
+            ep.put_msg(msg_type, msg_data.encode('utf8'))
+            try:
+                ep.send_all()
+            except OSError as ex:
+                print('<supervisor> send to process %d fail: %s' % (ep.pid, ex))
 # main
 # cnn_paramûpasswordôûmd5Ϊpassword
 def add_pwd_md5_if(cnn_param):
@@ -1178,6 +3049,55 @@ def register_to_mpool(addr):
     cnn_param.update(host=mhost, port=mport, database='pseudo')
     with pgnet.pgconn(**cnn_param) as cnn:
         cnn.query('register %s:%s' % (addr[0], addr[1]))
+# лnew_master_addrnew_master_addrĳӿĵַʱ򷵻شϢ
+def change_master(new_master_addr):
+    global master_pool
+    if new_master_addr == master_pool.be_addr:
+        return None
+    pool_list = slaver_pools.get_byaddr(new_master_addr)
+    if not pool_list:
+        return 'no pool for %s' % (new_master_addr,)
+    slaver_pools.remove(pool_list[0], clear=False)
+    slaver_pools.remove_byaddr(master_pool.be_addr, clear=True)
+    miscutils.remove_all(g_conf['slaver'], master_pool.be_addr)
+    master_pool.clear()
+    g_conf['global']['master_pool'] = master_pool = pool_list[0]
+    g_conf['master'] = master_pool.be_addr
+    g_conf['slaver'].remove(master_pool.be_addr)
+    if cache_listener:
+        cache_listener.reconnect = True
+    if cache_warmer:
+        cache_warmer.rewarm_all(master_pool)
+    return None
+# ģʽ°Ϣ
+def send_ctl_msg(msg_type, msg_data):
+    ctl_ep = g_conf['global']['ctl_ep']
+    ctl_ep.put_msg(msg_type, msg_data.encode('utf8'))
+    ctl_ep.send_all()
+# ģʽ´̷Ϣ˳ӽҲ˳
+def process_ctl_msg():
+    try:
+        msg_list = ctl_ep.recv_msgs()
+    except (RuntimeError, OSError) as ex:
+        print('supervisor exited: %s' % (ex,))
+        os._exit(1)
+    for msg_type, msg_data, fdlist in msg_list:
+        if msg_type == b'm':
+            host, port = msg_data.decode('utf8').split(':')
+            errmsg = change_master((host, int(port)))
+            print('change_master %s:%s: %s' % (host, port, errmsg or 'ok'))
+        elif msg_type == b'f': # Ѿȡstartup_msg
+            cnn = pgnet.feconn(socket.socket(fileno=fdlist[0]))
+            cnn.startup_msg = p.parse_startup_msg(msg_data)
+            fobj = pgnet.feconn4startup(cnn)
+            print('got connection from supervisor: %s' % (cnn.peername(),))
+            try:
+                process_startup_msg(fobj, cnn.startup_msg, poll.POLLIN)
+            except pgnet.pgfatal as ex:
+                print('%s: %s' % (ex.__class__.__name__, ex))
+                fobj.close()
+        else:
+            raise RuntimeError('unknown msg from supervisor:%s' % ((msg_type, msg_data),))
 # in event loop
 def process_main_queue():
     # process main_queue
@@ -1190,15 +3110,19 @@ def process_main_queue():
         print(x)
         if x[0] == 'ok': # ('ok', fecnn, worker)
             if x[1]:
-                poll.register(x[1], poll.POLLIN)
+                wait_fe_msg(x[1])
                 fepool.add(x[1])
             w = x[2]
             w.idle_timeout = g_conf.get('idle_timeout', 60*60*24)
-            if not query_cache_map.get(w.startup_msg, None):
-                query_cache_map[w.startup_msg] = QueryCache(w.startup_msg.md5().decode('ascii'))
+            if w.startup_msg not in query_cache_map: # յQueryCacheboolֵFalseԲgetж
+                query_cache_map[w.startup_msg] = query_cache_class(w.startup_msg.md5().decode('ascii'))
+                if cache_listener: # ־ָcache֮ǰѾʧЧ
+                    query_cache_map[w.startup_msg].clear_all_tables()
             w.query_cache = query_cache_map[w.startup_msg]
             if w.pool_id == master_pool.id:
                 master_pool.add(w)
+                if cache_warmer:
+                    cache_warmer.warm(master_pool, w.startup_msg)
             else:
                 slaver_pools.add_worker(w)
             # slaver workers
@@ -1226,7 +3150,14 @@ def process_main_queue():
                 slaver_pools.dispatch_worker_remain_msg(poll, w)
         elif x[0] == 'done': # ('done', fecnn, worker, (put_time, get_time, done_time))
             if isinstance(x[1], pgnet.feconn):
-                poll.register(x[1], poll.POLLIN)
+                x[1].pipeline_cnt -= 1
+                if x[1].pipeline_cnt <= 0:
+                    if x[1].send_sz: # fe_spool_threshold>0ʱ̷߳ʣµ
+                        poll.register(x[1], poll.POLLOUT)
+                    else:
+                        wait_fe_msg(x[1])
+            elif cache_warmer and type(x[1]) is tuple:
+                cache_warmer.done(master_pool, x[1])
             w = x[2]
             w.last_processed_msg_info = x[3]
         elif x[0] == 'pagecache': # ('pagecache', startup_msg, femsg, sql)
@@ -1234,6 +3165,21 @@ def process_main_queue():
             if time.time() > cache_timeout_map[sql]:
                 cache_timeout_map[sql] = time.time() + femsg._comment_info.cache
                 master_pool.dispatch_cmd_msg(startup_msg, ('pagecache', femsg))
+        elif x[0] == 'pagefetch': # ('pagefetch', PageCacheItem)
+            item = x[1]
+            if item.cursor and not item.fetching:
+                if master_pool.get_byid(item.worker.id) is item.worker:
+                    item.fetching = True
+                    item.worker.put(('pagefetch', item), None)
+                else: # workerѾ˳αҲ
+                    item.cursor = None
+                    item.qc.remove_item(item.sql, item)
+        elif x[0] == 'cacheclear': # ('cacheclear', tables)tablesstrбNoneʾкͱصcache
+            for qc in query_cache_map.values():
+                if x[1] is None:
+                    qc.clear_all_tables()
+                else:
+                    qc.clear(x[1], str)
         elif x[0] == 'pgdown': # ('pgdown', host, port)
             need_ha = True
         else:
@@ -1271,12 +3217,55 @@ def process_ha():
     slaver_pools.close_admin_cnn()
     print('process_ha done. master changed to %s. notify spool to change master' % (master_pool.be_addr,))
     notify_spool()
+    if cache_listener:
+        cache_listener.reconnect = True
+    if cache_warmer:
+        cache_warmer.rewarm_all(master_pool)
     mon_worker.start(host=g_conf['master'][0], port=g_conf['master'][1], **g_conf['admin_cnn'])
+# ǰ˵startup_msgģʽstartup_msgҲ̶ȡ֮ͬǰһ𴫹ġ
+# ߳¼ǰӡջѾϢôpoll᷵أŵready_fesֱӴ
+def wait_fe_msg(fecnn):
+    if fecnn.get_buffered_msg(remove=False):
+        poll.clear((fecnn,))
+        ready_fes.append(fecnn)
+    else:
+        poll.register(fecnn, poll.POLLIN)
+def process_startup_msg(fobj, m, event):
+    if m.code == p.PG_CANCELREQUEST_CODE:
+        addr_list = [g_conf['master']] + g_conf.get('slaver', [])
+        misc_worker.put('CancelRequest', (m, addr_list))
+        fobj.close()
+        return
+    if m.code == p.PG_SSLREQUEST_CODE:
+        fobj.write_no_ssl()
+        poll.register(fobj, poll.POLLIN)
+        return
+    if m.code != p.PG_PROTO_VERSION3_NUM or 'replication' in m.get_params():
+        fobj.write_msgs((p.ErrorResponse.make_error(b'do not support SSL or replication connection'),))
+        fobj.close()
+        return
+    # SCRAM޷pg_shadowбģ½ֻǰ˺ͺֱӽauth
+    # slaver workersֻеmaster workerɹŻΪpsqlһϿжǷҪ롣
+    is_pseudo = (m['database'] == b'pseudo')
+    if not is_pseudo:
+        need, param = need_new_worker(m)
+        if need:
+            w = master_pool.new_worker(fobj.cnn, main_queue)
+            if param:
+                slaver_workers_to_start[w.id] = param
+            return
+    # ӳؽauth
+    auth_ok_msgs = pooldb.auth_ok_msgs if is_pseudo else master_pool.get(m)[0].auth_ok_msgs
+    cnn = pooldb(fobj.cnn, g_conf) if is_pseudo else fobj.cnn
+    auth = pghba.get_auth(hba, shadows, cnn, m, auth_ok_msgs)
+    if auth.handle_event(poll, event):
+        if not isinstance(auth.cnn, pseudodb.pseudodb):
+            fepool.add(auth.cnn)
 # вԼȡļg_conf
 def process_args():
     xargs = miscutils.parse_args(sys.argv[1:])
-    if not xargs.keys() <= set(('mode', 'listen', 'conf', 'mpool')):
-        print('usage: %s [mode=master|slaver] [listen=host:port] [mpool=host:port] [conf=pgstmtpool.conf.py]' % sys.argv[0])
+    if not xargs.keys() <= set(('mode', 'listen', 'conf', 'mpool', 'procs')):
+        print('usage: %s [mode=master|slaver] [listen=host:port] [mpool=host:port] [procs=N] [conf=pgstmtpool.conf.py]' % sys.argv[0])
         sys.exit(1)
     conf_file = xargs['conf'][0] if xargs['conf'] else os.path.join(os.path.dirname(__file__), 'pgstmtpool.conf.py')
     g_conf = miscutils.read_conf_file(conf_file, 'all')
@@ -1296,6 +3285,8 @@ def process_args():
         g_conf['mpool'] = (host, int(port))
     else:
         g_conf['mpool'] = None
+    if xargs['procs']:
+        g_conf['procs'] = int(xargs['procs'][0])
     if g_conf['mode'] not in ('master', 'slaver'):
         print('mode shoule be master or slaver')
         sys.exit(1)
@@ -1315,32 +3306,86 @@ if __name__ == '__main__':
     g_conf['global']['shadows'] = shadows = pghba.pgshadow.from_database(admin_cnn)
     admin_cnn.close()
     
+    # ģʽ̲runأHA̸еchange_master/process_haҲõЩȫֱ
+    # pgsupervisor֮ǰʼӽٸֵ
+    cache_listener = None
+    cache_warmer = None
+    ctl_ep = None
+    if g_conf.get('procs', 1) > 1:
+        ctl_ep = pgsupervisor(g_conf['procs'], g_conf.get('procs_dispatch', 'reuseport')).run()
+        g_conf['enable_ha'] = False
+    g_conf['global']['ctl_ep'] = ctl_ep
+    
     g_conf['global']['master_pool'] = master_pool = pgstmtworkerpool(g_conf['master'])
     g_conf['global']['slaver_pools'] = slaver_pools = pgstmtworkerpools(*g_conf.get('slaver',()))
     g_conf['global']['fepool'] = fepool = feconnpool()
-    g_conf['global']['main_queue'] = main_queue = queue.Queue()
+    g_conf['global']['main_queue'] = main_queue = mainqueue()
     slaver_workers_to_start = {} # ¼Ҫslaver workers
     CacheItem.threshold_to_file = g_conf.get('cache_threshold_to_file', 10*1024)
-    QueryCache.root_dir = g_conf.get('cache_root_dir', 'querycache')
+    QueryCache.lru.max_bytes = g_conf.get('cache_max_bytes', 0)
+    QueryCache.lru.max_disk_bytes = g_conf.get('cache_max_disk_bytes', 0)
+    QueryCache.admission.min_count = g_conf.get('cache_admit_count', 0)
+    QueryCache.admission.min_build_time = g_conf.get('cache_admit_build_time', 0)
+    QueryCache.codec = get_codec(g_conf.get('cache_compress', None))
+    QueryCache.compress_block = g_conf.get('cache_compress_block', 64*1024)
+    pgmiscworker.expire_interval = g_conf.get('cache_expire_interval', 1)
+    pgstmtworker.page_fetch = g_conf.get('cache_page_fetch', 1000)
+    pgnet.feconn.spool_threshold = g_conf.get('fe_spool_threshold', 0)
+    pgnet.feconn.spool_dir = g_conf.get('fe_spool_dir', None)
+    if g_conf.get('worker_mode', 'thread') == 'mux':
+        pgmuxworker.engine = pgmuxengine.start()
+        pgstmtworkerpool.worker_class = pgmuxworker
+    # ͬһ̨ϵĶӳ(masterslaver)ʹòͬĿ¼ɾ߸Ǳ˴˵Ļļ
+    QueryCache.root_dir = os.path.join(g_conf.get('cache_root_dir', 'querycache'), '%s_%d' % (g_conf['mode'], g_conf['listen'][1]))
+    QueryCommentInfo.auto_tables = g_conf.get('cache_auto_tables', False)
+    if ctl_ep: # ÿӽʹԼĿ¼forkӽʹͬĿ¼Իָ֮ǰĻ
+        QueryCache.root_dir = os.path.join(QueryCache.root_dir, 'p%d' % ctl_ep.idx)
+    query_cache_class = QueryCache
+    if g_conf.get('cache_backend', 'local') == 'shm':
+        ShmQueryCache.open_hashtable(g_conf.get('cache_shm_name', 'querycache'), g_conf.get('cache_shm_size', 64*1024*1024))
+        query_cache_class = ShmQueryCache
     g_conf['global']['query_cache_map'] = query_cache_map = {} # startup_msg -> QueryCache
     
     # sql -> timeout  (sql is str)
     cache_timeout_map = collections.defaultdict(int)
     
     misc_worker = pgmiscworker.start()
+    if g_conf.get('cache_notify_channel', None):
+        pgcachelistener.batch_interval = g_conf.get('cache_notify_batch', 0.1)
+        cache_listener = pgcachelistener.start(main_queue, g_conf['cache_notify_channel'], g_conf['admin_cnn'])
+    if g_conf.get('cache_warm_file', None):
+        cache_warmer = pgcachewarmer.from_file(g_conf['cache_warm_file'], g_conf.get('cache_warm_concurrency', 2), g_conf.get('cache_warm_timeout', 300))
+    g_conf['global']['cache_warmer'] = cache_warmer
     if g_conf.get('enable_ha', False):
         mon_worker = pgmonitor(main_queue, g_conf.get('ha_after_fail_cnt', 10), g_conf.get('ha_check_interval', 3))
         mon_worker.start(**cnn_param)
     
-    listen = netutils.listener(g_conf['listen'], async=True)
-    register_to_mpool(listen.getsockname())
-    poll = netutils.spoller()
-    poll.register(listen, poll.POLLIN)
+    # procs_dispatch=startup_msgʱ̼˿
+    listen = None
+    if not ctl_ep or g_conf.get('procs_dispatch', 'reuseport') == 'reuseport':
+        listen = netutils.listener(g_conf['listen'], async=True, reuseport=bool(ctl_ep))
+    if not ctl_ep:
+        register_to_mpool(listen.getsockname())
+    poll = netutils.epoller()
+    if listen:
+        poll.register(listen, poll.POLLIN)
+    poll.register(main_queue.waker, poll.POLLIN)
+    if ctl_ep:
+        poll.register(ctl_ep, poll.POLLIN)
+    pipeline_max_msg = g_conf.get('pipeline_max_msg', 1)
+    ready_fes = [] # ջϢǰ
     while True:
-        poll_res = poll.poll(0.001)
+        poll_res = poll.poll(0 if ready_fes else None)
+        if ready_fes:
+            poll_res += [(fobj, poll.POLLIN) for fobj in ready_fes]
+            ready_fes.clear()
         for fobj, event in poll_res:
             try:
-                if fobj is listen:
+                if fobj is main_queue.waker:
+                    fobj.clear()
+                elif fobj is ctl_ep:
+                    process_ctl_msg()
+                elif fobj is listen:
                     cs, addr = fobj.accept()
                     print('accept connection from %s' % (addr,))
                     poll.register(pgnet.feconn4startup(pgnet.feconn(cs)), poll.POLLIN)
@@ -1349,36 +3394,7 @@ if __name__ == '__main__':
                     if not m:
                         continue
                     poll.unregister(fobj)
-                    if m.code == p.PG_CANCELREQUEST_CODE:
-                        addr_list = [g_conf['master']] + g_conf.get('slaver', [])
-                        misc_worker.put('CancelRequest', (m, addr_list))
-                        fobj.close()
-                        continue
-                    if m.code == p.PG_SSLREQUEST_CODE:
-                        fobj.write_no_ssl()
-                        poll.register(fobj, poll.POLLIN)
-                        continue
-                    if m.code != p.PG_PROTO_VERSION3_NUM or 'replication' in m.get_params():
-                        fobj.write_msgs((p.ErrorResponse.make_error(b'do not support SSL or replication connection'),))
-                        fobj.close()
-                        continue
-                    # SCRAM޷pg_shadowбģ½ֻǰ˺ͺֱӽauth
-                    # slaver workersֻеmaster workerɹŻΪpsqlһϿжǷҪ롣
-                    is_pseudo = (m['database'] == b'pseudo')
-                    if not is_pseudo:
-                        need, param = need_new_worker(m)
-                        if need:
-                            w = master_pool.new_worker(fobj.cnn, main_queue)
-                            if param:
-                                slaver_workers_to_start[w.id] = param
-                            continue
-                    # ӳؽauth
-                    auth_ok_msgs = pooldb.auth_ok_msgs if is_pseudo else master_pool.get(m)[0].auth_ok_msgs
-                    cnn = pooldb(fobj.cnn, g_conf) if is_pseudo else fobj.cnn
-                    auth = pghba.get_auth(hba, shadows, cnn, m, auth_ok_msgs)
-                    if auth.handle_event(poll, event):
-                        if not isinstance(auth.cnn, pseudodb.pseudodb):
-                            fepool.add(auth.cnn)
+                    process_startup_msg(fobj, m, event)
                 elif isinstance(fobj, pghba.pgauth):
                     poll.unregister(fobj)
                     if fobj.handle_event(poll, event):
@@ -1387,13 +3403,13 @@ if __name__ == '__main__':
                 elif type(fobj) is pgnet.feconn:
                     if event & poll.POLLOUT:
                         if not fobj.write_msgs():
-                            poll.register(fobj, poll.POLLIN)
+                            wait_fe_msg(fobj)
                         continue
                     m = fobj.read_msgs(max_msg=1)
                     if not m:
                         continue
                     m = m[0]
-                    poll.unregister(fobj) # ֹ߳ͣ⣬ѿȨworker
+                    poll.clear((fobj,)) # ֹ߳ͣ⣬ѿȨworkerready_fesfobjûעᡣ
                     try:
                         m = parse_query_comment(m)
                     except Exception as ex:
@@ -1401,16 +3417,32 @@ if __name__ == '__main__':
                         if fobj.write_msgs((errmsg, p.ReadyForQuery.Idle)):
                             poll.register(fobj, poll.POLLOUT)
                         else:
-                            poll.register(fobj, poll.POLLIN)
+                            wait_fe_msg(fobj)
                         continue
+                    # pipeline: ջѾеQueryϢһַͬһworker
+                    # QueryϢעͳӲͬϢֹͣһδ
+                    m_list = [m]
+                    while m.msg_type == p.MsgType.MT_Query and len(m_list) < pipeline_max_msg:
+                        m2 = fobj.get_buffered_msg(remove=False)
+                        if not m2 or m2.msg_type != p.MsgType.MT_Query:
+                            break
+                        try:
+                            m2 = parse_query_comment(m2)
+                        except Exception:
+                            break
+                        if m2._comment_info.master != m._comment_info.master:
+                            break
+                        fobj.get_buffered_msg()
+                        m_list.append(m2)
+                    fobj.pipeline_cnt = len(m_list)
                     if m._comment_info.master:
-                        master_pool.dispatch_fe_msg(poll, fobj, m)
+                        master_pool.dispatch_fe_msgs(poll, fobj, m_list)
                         continue
                     if slaver_pools.has_worker(fobj):
-                        slaver_pools.dispatch_fe_msg(poll, fobj, m)
+                        slaver_pools.dispatch_fe_msgs(poll, fobj, m_list)
                     else: 
                         # fobj.startup_msgg_conf['conn_params']ƥ䣬дӿworkerѾ쳣
-                        master_pool.dispatch_fe_msg(poll, fobj, m)
+                        master_pool.dispatch_fe_msgs(poll, fobj, m_list)
                         wcnt = master_pool.count(fobj)
                         if wcnt > 0: 
                             cnn_param = get_slaver_cnn_param(fobj.startup_msg)
@@ -9,7 +9,7 @@ import sys, os, re
 import struct
 import itertools
 import collections
-from miscutils import get_cstr
+from pgparse import get_cstr
 
 __all__ = ['mvfrombuf', 'structview']
 